@@ -0,0 +1,52 @@
+"""In-memory caches of catalog information"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+class DataObjectCache(object):
+    """Bounded cache of data object rows, keyed by physical path.
+
+    When the cache is full, the rows that were added first are evicted.
+    Rows are removed from the cache when they are looked up, since each
+    file in a vault is only checked once."""
+
+    def __init__(self, max_entries):
+        if max_entries < 1:
+            raise ValueError("Cache size must be at least 1")
+        self.max_entries = max_entries
+        self.rows = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, phy_path, row):
+        self.rows[phy_path] = row
+        self.rows.move_to_end(phy_path)
+        while len(self.rows) > self.max_entries:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, phy_path):
+        """Returns the cached row for a physical path, or None if the
+        path is not in the cache."""
+        return self.rows.pop(phy_path, None)
+
+
+class CollectionIndex(object):
+    """Set of collection names, stored as a sorted list to keep memory
+    usage low for large numbers of collections."""
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        position = bisect_left(self.names, name)
+        return position < len(self.names) and self.names[position] == name
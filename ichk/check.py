@@ -1,19 +1,35 @@
 """Scan and check resource or vault"""
 
+import copy
+import heapq
 import os
+import shutil
 import sys
-from collections import namedtuple
+import tempfile
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from enum import Enum
+from functools import partial
 from itertools import chain
 
 import irods.exception as iexc
-from irods.column import Like
+from irods.column import In, Like
 from irods.data_object import irods_basename, irods_dirname
 from irods.models import Collection, DataObject, Resource
 
+from ichk.catalog_cache import CollectionIndex, DataObjectCache
+from ichk.concurrency import ConcurrencyController
 from ichk.formatters import Formatter
+from ichk.path_index import PathIndex
+from ichk.pipeline import StagedPipeline
+from ichk.resource_graph import ResourceGraph
 from ichk.resource_interface_factory import ResourceInterfaceFactory
+from ichk.statistics import RunStatistics
 from ichk.status_codes import ReplicaStatus, Status
+from ichk.vault_walker import walk_key, walk_vault, walk_vault_in_order
+from ichk.worker_pool import OrderedWorkerPool
 
 
 class ObjectType(Enum):
@@ -27,10 +43,20 @@ Result = namedtuple(
     'Result',
     'obj_type obj_path phy_path status replica_status observed_values resource')
 
+# A check of a replica of which the existence and size have been checked
+PendingCheck = namedtuple(
+    'PendingCheck',
+    'data_object interface phy_path obj_type metadata exists status observed_values '
+    'no_verify_checksum')
+
 
 class ObjectChecker(object):
-    def __init__(self, session):
-        self.interface_factory = ResourceInterfaceFactory(session)
+    def __init__(self, session, resource_graph, checksum_cache=None,
+                 statistics=None, rate_limiter=None, s3_options=None,
+                 concurrency=None):
+        self.interface_factory = ResourceInterfaceFactory(
+            session, resource_graph, checksum_cache, statistics, rate_limiter,
+            s3_options, concurrency)
 
     def get_obj_name(self, data_object):
         return "{}/{}".format(
@@ -39,28 +65,55 @@ class ObjectChecker(object):
         )
 
     def get_result(self, data_object, resource_name,
-                   phy_path, no_verify_checksum=False):
+                   phy_path, no_verify_checksum=False,
+                   obj_type=ObjectType.DATAOBJECT, metadata=None):
+        """Check a replica. Metadata of the replica that is already known
+        (e.g. the os.DirEntry of a file in vault mode) can be passed, so that
+        it does not have to be retrieved again."""
+        return self.check_contents(self.check_metadata(
+            data_object, resource_name, phy_path, no_verify_checksum,
+            obj_type, metadata))
+
+    def check_metadata(self, data_object, resource_name,
+                       phy_path, no_verify_checksum=False,
+                       obj_type=ObjectType.DATAOBJECT, metadata=None):
+        """First part of a check of a replica: its existence and size.
+        Returns a PendingCheck for check_contents."""
         interface = self.interface_factory.get_resource_interface(
             resource_name)
-        status = interface.check_object_exists(phy_path)
-        replica_status = ReplicaStatus(
-            int(data_object[DataObject.replica_status]))
-        observed_values = {}
 
         if interface is None:
             print(f"Error: unable to find resource {resource_name}.")
             sys.exit(1)
 
-        if status == Status.OK:
+        status, metadata = interface.stat_object(phy_path, metadata)
+        exists = status == Status.OK
+        observed_values = {}
+
+        if exists:
             # File exists on disk and is accessible
             status, observed_filesizes = self.compare_filesize(
-                data_object, interface, phy_path)
+                data_object, interface, phy_path, metadata)
             observed_values.update(observed_filesizes)
-            if status == Status.OK and not no_verify_checksum:
+
+        return PendingCheck(data_object, interface, phy_path, obj_type, metadata,
+                            exists, status, observed_values, no_verify_checksum)
+
+    def check_contents(self, check):
+        """Second part of a check of a replica: its checksum. Returns the
+        result of the check."""
+        data_object = check.data_object
+        status = check.status
+        observed_values = check.observed_values
+        replica_status = ReplicaStatus(
+            int(data_object[DataObject.replica_status]))
+
+        if check.exists:
+            if status == Status.OK and not check.no_verify_checksum:
                 status, observed_checksums = self.compare_checksums(
-                    data_object, interface, phy_path)
+                    data_object, check.interface, check.phy_path, check.metadata)
                 observed_values.update(observed_checksums)
-            elif no_verify_checksum:
+            elif check.no_verify_checksum:
                 observed_values.update({'expected_checksum': self.format_full_checksum(data_object[DataObject.checksum]),
                                         'observed_checksum': "N/A (checksum verification disabled)"})
 
@@ -69,13 +122,13 @@ class ObjectChecker(object):
                 # locked)
                 status = Status.REPLICA_NOT_GOOD
 
-        return Result(ObjectType.DATAOBJECT, self.get_obj_name(data_object),
-                      phy_path, status, replica_status.name, observed_values,
+        return Result(check.obj_type, self.get_obj_name(data_object),
+                      check.phy_path, status, replica_status.name, observed_values,
                       data_object[Resource.name])
 
-    def compare_filesize(self, data_object, interface, phy_path):
+    def compare_filesize(self, data_object, interface, phy_path, metadata=None):
         data_object_size = data_object[DataObject.size]
-        observed_size = interface.get_size(phy_path)
+        observed_size = interface.get_size(phy_path, metadata)
 
         info = {
             'expected_filesize': data_object_size,
@@ -92,7 +145,7 @@ class ObjectChecker(object):
         else:
             return f"md5:{checksum}"
 
-    def compare_checksums(self, data_object, interface, phy_path):
+    def compare_checksums(self, data_object, interface, phy_path, metadata=None):
         irods_checksum = data_object[DataObject.checksum]
         info = {}
 
@@ -104,7 +157,7 @@ class ObjectChecker(object):
         else:
             checksum_type = "md5"
 
-        phy_checksum = interface.get_checksum(phy_path, checksum_type)
+        phy_checksum = interface.get_checksum(phy_path, checksum_type, metadata)
 
         info = {
             'expected_checksum': f"{checksum_type}:{irods_checksum}",
@@ -118,11 +171,54 @@ class ObjectChecker(object):
 
 
 class Check(object):
-
-    def __init__(self, session, fqdn, root_collection):
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, session, fqdn, root_collection, workers=1,
+                 checksum_cache=None, state=None, resume_data=None,
+                 rate_limiter=None, s3_options=None, shard=None,
+                 resource_threads=1, per_device=1, locality_window=0,
+                 locality_order="inode", modified_since=None, pipeline=False,
+                 metadata_workers=4, session_pool=None, query_retries=5,
+                 concurrency=None):
         self.fqdn = fqdn
         self.session = session
-        self.object_checker = ObjectChecker(session)
+        self.session_pool = session_pool
+        self.checksum_cache = checksum_cache
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency if concurrency is not None else ConcurrencyController()
+        self.shard = shard
+        self.modified_since = modified_since
+        self.query_retries = query_retries
+        self.resource_graph = ResourceGraph(session)
+        self.statistics = RunStatistics()
+        self.object_checker = ObjectChecker(
+            session, self.resource_graph, checksum_cache, self.statistics,
+            rate_limiter, s3_options, self.concurrency)
+        self.interface_factory = self.object_checker.interface_factory
+        self.workers = workers
+        self.locality_window = locality_window
+        self.locality_order = locality_order
+        self.pipeline = pipeline
+        self.metadata_workers = metadata_workers
+        self.results = self.result_pool(self._emit)
+        self.resource_threads = resource_threads
+        self.per_device = per_device
+        self.state = state
+        self.started = time.time()
+        self.progress = {"completed_resources": [],
+                         "resource": None,
+                         "completed_leaves": [],
+                         "leaf": None,
+                         "position": None,
+                         "header_written": False}
+        self.resumed_progress = None
+
+        if resume_data is not None:
+            self.started = resume_data["started"]
+            self.resumed_progress = resume_data["progress"]
+            self.progress = copy.deepcopy(self.resumed_progress)
+            self.statistics.restore(resume_data["statistics"])
 
         if root_collection is not None:
             found_collection = (self.session.query(Collection.id, Collection.name)
@@ -145,42 +241,361 @@ class Check(object):
         for formatter in formatters:
             if formatter.name == fmt:
                 self.formatter = formatter(output, **options)
+                self.formatter_options = options
                 break
         else:
             raise ValueError("Unknown formatter: {}".format(fmt))
 
-    def get_resource(self, resource_name):
+    def result_pool(self, consumer):
+        """Returns the pool that runs checks and passes their results to the
+        consumer in order: a pipeline with a metadata and a checksum stage,
+        or a pool of workers that run complete checks."""
+        if self.pipeline:
+            return StagedPipeline(
+                consumer, [("metadata", self.object_checker.check_metadata, self.metadata_workers),
+                           ("checksum", self.object_checker.check_contents, self.workers)])
+        return OrderedWorkerPool(consumer, self.workers, window=self.locality_window)
+
+    def _emit(self, result):
+        self.formatter(result)
+        self.statistics.increment(
+            "Results with status {}".format(result.status.name))
+
+    def write_header(self):
+        """Write the header of the output, unless a resumed run already did"""
+        if not self.progress["header_written"]:
+            self.formatter.head()
+            self.progress["header_written"] = True
+
+    def resource_done(self, resource_name):
+        """Returns whether a resource was completely checked by the run that
+        is being resumed."""
+        return (self.resumed_progress is not None
+                and resource_name in self.resumed_progress["completed_resources"])
+
+    def leaf_done(self, resource_name, leaf_name):
+        """Returns whether a leaf resource was completely checked by the run
+        that is being resumed."""
+        return (self.resumed_progress is not None
+                and self.resumed_progress["resource"] == resource_name
+                and leaf_name in self.resumed_progress["completed_leaves"])
+
+    def resume_position(self, resource_name, leaf_name):
+        """Returns the position within a leaf resource up to which the run
+        that is being resumed checked it, or None."""
+        if (self.resumed_progress is not None
+                and self.resumed_progress["resource"] == resource_name
+                and self.resumed_progress["leaf"] == leaf_name):
+            return self.resumed_progress["position"]
+        return None
+
+    def start_resource(self, resource_name):
+        if self.progress["resource"] != resource_name:
+            self.progress.update(resource=resource_name, completed_leaves=[],
+                                 leaf=None, position=None)
+
+    def start_leaf(self, leaf_name):
+        if self.progress["leaf"] != leaf_name:
+            self.progress.update(leaf=leaf_name, position=None)
+
+    def record_position(self, position):
+        """Record that everything up to a position (e.g. a collection or
+        directory) within the current leaf resource has been checked."""
+        self.progress["position"] = position
+        self.save_state_if_due()
+
+    def finish_leaf(self):
+        self.progress["completed_leaves"].append(self.progress["leaf"])
+        self.progress.update(leaf=None, position=None)
+        self.save_state_if_due()
+
+    def finish_resource(self):
+        self.progress["completed_resources"].append(self.progress["resource"])
+        self.progress.update(resource=None, completed_leaves=[])
+        self.save_state_if_due()
+
+    def save_state_if_due(self):
+        if self.state is not None and self.state.save_due():
+            self.save_state()
+
+    def save_state(self, completed=False):
+        """Write all pending results and save the progress of the run, along
+        with the size of the output, so that a resumed run can discard output
+        that was written after the last save."""
+        self.results.flush()
+        output = self.formatter.output
+        output.flush()
         try:
-            resource = self.session.query(Resource).filter(
-                Resource.name == resource_name).one()
-        except iexc.NoResultFound:
-            resource = None
-        return resource
+            output_offset = output.tell()
+        except OSError:
+            output_offset = None
+
+        data = {"started": self.started,
+                "completed": completed,
+                "progress": self.progress,
+                "output_offset": output_offset,
+                "modified_since": self.modified_since,
+                "statistics": self.statistics.as_dict()}
+        if completed:
+            data["finished"] = time.time()
+        self.state.save(data)
+
+    def in_shard(self, key):
+        """Returns whether work with a key (e.g. a collection name) is part of
+        the shard of this check, if any"""
+        return self.shard is None or key in self.shard
+
+    def is_modified(self, timestamp):
+        """Returns whether something that was last modified at a time (in
+        seconds since the epoch) should be checked by an incremental check"""
+        return self.modified_since is None or timestamp >= self.modified_since
+
+    def filter_modified(self, query):
+        """Restricts a data object query to the data objects that should be
+        checked by an incremental check"""
+        if self.modified_since is None:
+            return query
+        return query.filter(DataObject.modify_time
+                            >= datetime.fromtimestamp(self.modified_since, timezone.utc))
+
+    def in_root_collection(self, query):
+        """Returns queries for the rows of a query that are in the root
+        collection, if set: one for the root collection itself, and one for
+        its subcollections. Queries are passed and returned as functions that
+        return a new query (see query_results)."""
+        if self.root_collection is None:
+            return [query]
+        return [lambda: query().filter(Collection.name == self.root_collection),
+                lambda: query().filter(Like(Collection.name, self.root_collection + "/%%"))]
 
-    def get_local_ufs_resources(self, fqdn):
+    def device_of(self, resource):
+        """Returns the block device (st_dev) of the vault of a local
+        unixfilesystem resource, or None for other resources."""
+        if resource[Resource.type] != "unixfilesystem":
+            return None
         try:
-            return self.session.query(Resource).filter(Resource.location == fqdn).filter(
-                Resource.type == "unixfilesystem").get_results()
-        except iexc.NoResultFound:
+            return os.stat(resource[Resource.vault_path]).st_dev
+        except OSError:
             return None
 
+    def unit_check(self, output):
+        """Returns a copy of the check for a unit of work (e.g. a leaf
+        resource) that runs concurrently with other units. The copy has its
+        own worker pool and writes its results to a separate output. It gets
+        a session of its own in run_units. The resource interfaces and
+        statistics are shared."""
+        unit = copy.copy(self)
+        unit.formatter = type(self.formatter)(output, **self.formatter_options)
+        unit.results = unit.result_pool(unit._emit)
+        unit.progress = copy.deepcopy(self.progress)
+        return unit
+
+    def finish_unit(self, unit):
+        """Called when a unit of work has been completed"""
+        if self.pipeline:
+            self.results.add_samples(unit.results)
+        else:
+            self.results.submitted_distance += unit.results.submitted_distance
+            self.results.executed_distance += unit.results.executed_distance
+
+    def run_units(self, units, process):
+        """Runs units of work concurrently, with at most resource_threads
+        units at a time and at most per_device units per block device, so that
+        independent disks are checked in parallel without thrashing any of
+        them. Each unit writes its results to a temporary file. These files are
+        copied to the output in the order of the units, so the output is the
+        same as that of a serial check.
+
+        :param units: list of (device, args) tuples. The device is the block
+                      device of the unit, or None if the unit should not be
+                      limited per device.
+        :param process: function that is called with a copy of the check and
+                        the args of a unit"""
+        def run_unit(unit, args):
+            # Queries of concurrent units must not share connections, because
+            # a query that returns several pages is continued on the
+            # connection on which it was started
+            if self.session_pool is None:
+                unit.session = self.session.clone()
+                try:
+                    process(unit, *args)
+                finally:
+                    unit.session.cleanup()
+            else:
+                with self.session_pool.session() as session:
+                    unit.session = session
+                    process(unit, *args)
+            unit.results.close()
+
+        pending = list(enumerate(units))
+        running = {}
+        completed = {}
+        device_units = Counter()
+        next_unit = 0
+
+        with ThreadPoolExecutor(self.resource_threads) as executor:
+            while pending or running:
+                for item in list(pending):
+                    if len(running) >= self.resource_threads:
+                        break
+                    index, (device, args) = item
+                    if device is not None and device_units[device] >= self.per_device:
+                        continue
+                    pending.remove(item)
+                    device_units[device] += 1
+                    unit = self.unit_check(tempfile.TemporaryFile(mode="w+", newline=""))
+                    future = executor.submit(run_unit, unit, args)
+                    running[future] = (index, device, unit)
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, device, unit = running.pop(future)
+                    device_units[device] -= 1
+                    future.result()
+                    self.finish_unit(unit)
+                    completed[index] = unit.formatter.output
+
+                while next_unit in completed:
+                    spool = completed.pop(next_unit)
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, self.formatter.output)
+                    spool.close()
+                    next_unit += 1
+
+    def check_object(self, data_object, resource_name, phy_path,
+                     obj_type=ObjectType.DATAOBJECT, metadata=None):
+        """Schedule a check of a replica. The result is passed to the formatter
+        in order, after the results of all previously scheduled checks."""
+        # Create the resource interface on this thread, so that worker threads
+        # do not have to.
+        interface = self.interface_factory.get_resource_interface(resource_name)
+        if self.pipeline:
+            self.results.submit(data_object, resource_name, phy_path,
+                                self.no_verify_checksum, obj_type, metadata)
+        elif self.locality_window and interface is not None:
+            key, metadata = interface.locality_key(phy_path, metadata,
+                                                   self.locality_order)
+            self.results.submit_in_window(key, self.object_checker.get_result,
+                                          data_object, resource_name, phy_path,
+                                          self.no_verify_checksum, obj_type, metadata)
+        else:
+            self.results.submit(self.object_checker.get_result,
+                                data_object, resource_name, phy_path,
+                                self.no_verify_checksum, obj_type, metadata)
+
+    def close(self):
+        """Wait for scheduled checks to finish, release worker threads and
+        report statistics of the run"""
+        self.results.close()
+        if self.checksum_cache is not None:
+            self.statistics.increment("Checksum cache hits",
+                                      self.checksum_cache.hits)
+            self.statistics.increment("Checksum cache misses",
+                                      self.checksum_cache.misses)
+        if self.session_pool is not None and self.session_pool.created:
+            self.statistics.increment("iRODS sessions opened",
+                                      self.session_pool.created)
+            self.statistics.increment("iRODS session reconnects",
+                                      self.session_pool.reconnects)
+        if self.rate_limiter is not None:
+            self.statistics.increment("Rate limit delay (s)",
+                                      self.rate_limiter.delay)
+        self.concurrency.add_statistics(self.statistics)
+        if self.pipeline:
+            for stage, depth in self.results.queue_depths():
+                self.statistics.increment(
+                    "Average queue depth of {} stage".format(stage), float(depth))
+        elif self.results.submitted_distance > 0:
+            self.statistics.increment(
+                "Seek distance reduction by locality ordering (%)",
+                100.0 * (1 - self.results.executed_distance
+                         / self.results.submitted_distance))
+        hashing_time = self.statistics.get("Hashing time (s)")
+        if hashing_time > 0:
+            self.statistics.increment(
+                "Hashing rate (MB/s)",
+                self.statistics.get("Bytes hashed") / hashing_time / 1e6)
+        if self.state is not None:
+            self.save_state(completed=True)
+        self.statistics.report(sys.stderr)
+
+    def query_results(self, query, resume_key=None):
+        """Returns a generator for the results of a catalog query. The query
+        is a function that returns a new query, because filtering a query
+        also changes the criteria of the query it was derived from, so that
+        retried queries have to be built from scratch. Each page of results
+        is counted as a catalog query in the statistics.
+
+        If a page can't be retrieved because of a network error or timeout,
+        the query is retried after an exponentially increasing delay. If
+        resume_key is set (a list of columns by which the query is ordered,
+        and which together identify a row), the retried query continues after
+        the last row that was returned. Otherwise, the query is only retried
+        if no rows have been returned yet."""
+        last_row = None
+        retries = 0
+        failed_at = None
+        while True:
+            try:
+                for resumed_query in self.queries_after(query, resume_key, last_row):
+                    batches = resumed_query.get_batches()
+                    while True:
+                        requested_at = time.monotonic()
+                        with self.concurrency.operation("catalog"):
+                            batch = next(batches, None)
+                        if batch is None:
+                            break
+                        self.statistics.increment("Catalog queries")
+                        if failed_at is not None:
+                            self.statistics.increment(
+                                "Time lost to catalog query retries (s)",
+                                time.monotonic() - failed_at)
+                            failed_at = None
+                        retries = 0
+                        for row in batch:
+                            last_row = row
+                            yield row
+                return
+            except (iexc.NetworkException, OSError) as e:
+                if retries >= self.query_retries or (last_row is not None and resume_key is None):
+                    raise
+                if failed_at is None:
+                    failed_at = requested_at
+                delay = min(self.RETRY_DELAY * 2 ** retries, self.MAX_RETRY_DELAY)
+                retries += 1
+                self.statistics.increment("Catalog query retries")
+                print("Warning: catalog query failed ({}), retrying in {} s ({}/{}).".format(
+                      e, delay, retries, self.query_retries), file=sys.stderr)
+                time.sleep(delay)
+
+    def queries_after(self, query, resume_key, last_row):
+        """Returns queries for the rows of an ordered query that come after
+        last_row, in the order of the query. GenQuery conditions can't be
+        combined with OR, so for a resume key of several columns there is a
+        query for each column: rows that match last_row on the preceding
+        columns and sort after it on this column."""
+        if last_row is None:
+            return [query()]
+        queries = []
+        for index, column in enumerate(resume_key):
+            resumed_query = query()
+            for preceding in resume_key[:index]:
+                resumed_query = resumed_query.filter(preceding == last_row[preceding])
+            queries.append(resumed_query.filter(column > last_row[column]))
+        queries.reverse()
+        return queries
+
+    def get_resource(self, resource_name):
+        return self.resource_graph.get(resource_name)
+
+    def get_local_ufs_resources(self, fqdn):
+        return self.resource_graph.at_location(fqdn, ["unixfilesystem"])
+
     def get_local_supported_resources(self, fqdn):
-        try:
-            return self.session.query(Resource).filter(Resource.location == fqdn).filter(
-                Resource.type == "unixfilesystem" or Resource.type == "s3").get_results()
-        except iexc.NoResultFound:
-            return None
+        return self.resource_graph.at_location(fqdn, ["unixfilesystem", "s3"])
 
     def get_resource_from_phy_path(self, phy_path):
-        try:
-            resource = (self.session.query(Resource)
-                        .filter(Resource.vault_path == phy_path)
-                        .filter(Resource.location == self.fqdn)
-                        .one()
-                        )
-        except iexc.NoResultFound:
-            resource = None
-        return resource
+        return self.resource_graph.get_by_vault_path(phy_path, self.fqdn)
 
     @property
     def vault(self):
@@ -200,22 +615,15 @@ class Check(object):
     def find_root(self, resource):
         ancestors = []
 
-        def climb(resource):
-            parent = resource[Resource.parent]
-            if parent is None:
-                print("Root resource is {}".format(resource[Resource.name]),
-                      file=sys.stderr)
-                return resource
-            else:
-                ancestor = (
-                    self.session.query(Resource.id, Resource.name)
-                    .filter(Resource.id == parent)
-                    .one()
-                )
-                ancestors.append(ancestor[Resource.name])
-                return climb(self.get_resource(ancestor[Resource.name]))
-
-        root = climb(resource)
+        root = resource
+        parent = self.resource_graph.parent(root)
+        while parent is not None:
+            ancestors.append(parent[Resource.name])
+            root = parent
+            parent = self.resource_graph.parent(root)
+
+        print("Root resource is {}".format(root[Resource.name]),
+              file=sys.stderr)
         ancestors.reverse()
         return root, ancestors
 
@@ -236,11 +644,10 @@ class Check(object):
 
         while len(to_visit) > 0:
             node, ancestors = to_visit.pop(0)
-            children = node[Resource.children]
+            children = self.resource_graph.children(node)
             if children:
                 ancestors_of_children = ancestors + [node[Resource.name]]
-                for child in (c.strip("{}") for c in children.split(";")):
-                    child_resource = self.get_resource(child)
+                for child_resource in children:
                     to_visit.append((child_resource, ancestors_of_children))
 
             elif node[Resource.location] == self.fqdn:
@@ -266,172 +673,282 @@ class ResourceCheck(Check):
 
     def __init__(self, session, fqdn, resource_name,
                  root_collection, all_local_resources=False,
-                 no_verify_checksum=False):
-        super(ResourceCheck, self).__init__(session, fqdn, root_collection)
+                 no_verify_checksum=False, stream_catalog=False, **options):
+        super(ResourceCheck, self).__init__(
+            session, fqdn, root_collection, **options)
         self.resource_name = resource_name
         self.all_local_resources = all_local_resources
-        self.interface_factory = ResourceInterfaceFactory(session)
+        self.stream_catalog = stream_catalog
         self.no_verify_checksum = no_verify_checksum
 
     def run(self):
         if self.all_local_resources:
 
-            resource_data = self.get_local_supported_resources(self.fqdn)
-            if resource_data is None:
+            resources = self.get_local_supported_resources(self.fqdn)
+            if not resources:
                 print(
-                    "Error: no local unixfilesystem resources found.",
+                    "Error: no local unixfilesystem or S3 resources found.",
                     file=sys.stderr)
                 sys.exit(1)
-            resources = list(resource_data)
-            resources.sort(key=lambda r: r[Resource.name])
-
-            resource_number = 0
-            for resource in resources:
-                self.process_resource(resource, resource_number == 0)
-                resource_number += 1
         else:
             resource = self.get_resource(self.resource_name)
             if resource is None:
                 print("Error: resource {} not found".format(self.resource_name),
                       file=sys.stderr)
                 sys.exit(1)
-            self.process_resource(resource, True)
+            resources = [resource]
+
+        if self.resource_threads > 1:
+            self.process_resources_concurrently(resources)
+        else:
+            for resource_number, resource in enumerate(resources):
+                self.process_resource(resource, resource_number == 0)
+
+    def process_resources_concurrently(self, resources):
+        """Checks the leaves of all resources concurrently"""
+        self.write_header()
+        units = []
+        for resource in resources:
+            print("Checking resource {} for consistency"
+                  .format(resource[Resource.name]), file=sys.stderr)
+            root, ancestors = self.find_root(resource)
+            for leaf, hiera in self.find_leaves(resource, ancestors):
+                units.append((self.device_of(leaf), (leaf, hiera)))
+        self.run_units(units, ResourceCheck.check_leaf)
 
     def process_resource(self, resource, print_header):
         resource_name = resource[Resource.name]
 
+        if self.resource_done(resource_name):
+            print("Skipping resource {}, since it has already been checked"
+                  .format(resource_name), file=sys.stderr)
+            return
+
         print("Checking resource {} for consistency"
               .format(resource_name), file=sys.stderr)
 
         if print_header:
-            self.formatter.head()
+            self.write_header()
 
+        self.start_resource(resource_name)
         root, ancestors = self.find_root(resource)
         for leaf, hiera in self.find_leaves(resource, ancestors):
-            resource_hierarchy = ";".join(hiera)
-            self.check_collections(
-                leaf[Resource.name], resource_hierarchy, leaf[Resource.vault_path])
+            leaf_name = leaf[Resource.name]
+            if self.leaf_done(resource_name, leaf_name):
+                continue
+            self.start_leaf(leaf_name)
+            self.check_leaf(leaf, hiera,
+                            self.resume_position(resource_name, leaf_name))
+            self.finish_leaf()
+        self.finish_resource()
 
-    def collections_in_root(self, resource_name):
-        """Returns a generator for all the Collections in the root resource"""
-        if self.root_collection is None:
-            return (self.session.query(Collection.id, Collection.name)
-                    .filter(Resource.name == resource_name)
-                    .get_results()
-                    )
+    def check_leaf(self, leaf, hiera, resume_position=None):
+        resource_hierarchy = ";".join(hiera)
+        if self.stream_catalog:
+            check_collections = self.check_collections_streamed
         else:
-            generator_collection = (self.session.query(Collection.id, Collection.name)
-                                    .filter(Resource.name == resource_name)
-                                    .filter(Collection.name == self.root_collection)
-                                    .get_results()
-                                    )
-            generator_subcollections = (self.session.query(Collection.id, Collection.name)
-                                        .filter(Resource.name == resource_name)
-                                        .filter(Like(Collection.name, self.root_collection + "/%%"))
-                                        .get_results()
-                                        )
-            return chain(generator_collection, generator_subcollections)
+            check_collections = self.check_collections
+        check_collections(
+            leaf[Resource.name], resource_hierarchy, leaf[Resource.vault_path],
+            resume_position)
+
+    def collections_in_root(self, resource_name, after_id=None):
+        """Returns a generator for all the Collections in the root resource,
+        ordered by id. If after_id is set, only collections with a higher id
+        are returned."""
+        def query():
+            query = (self.session.query(Collection.id, Collection.name)
+                     .filter(Resource.name == resource_name)
+                     .order_by(Collection.id))
+            if after_id is not None:
+                query = query.filter(Collection.id > after_id)
+            return query
+
+        return heapq.merge(*[self.query_results(query, [Collection.id])
+                             for query in self.in_root_collection(query)],
+                           key=lambda coll: coll[Collection.id])
 
     def data_objects_in_collection(self, coll_id, resource_hierarchy):
         """Returns a generator for all data objects in a collection"""
-        return (self.session.query(DataObject, Collection.name, Resource.name)
-                .filter(Collection.id == coll_id)
+        return self.query_results(lambda: self.filter_modified(
+            self.session.query(DataObject, Collection.name, Resource.name)
+            .filter(Collection.id == coll_id)
+            .filter(DataObject.resc_hier == resource_hierarchy)
+            .order_by(DataObject.id)
+        ), [DataObject.id])
+
+    def data_objects_in_hierarchy(self, resource_hierarchy, after_coll_name=None):
+        """Returns a generator for all data objects in a resource hierarchy
+        (within the root collection, if set), ordered by collection name, so
+        that the data objects of a collection are returned consecutively.
+        If after_coll_name is set, only data objects in collections that sort
+        after it are returned."""
+        def query():
+            query = self.filter_modified(
+                self.session.query(DataObject, Collection.name, Resource.name)
                 .filter(DataObject.resc_hier == resource_hierarchy)
-                .get_results()
-                )
+                .order_by(Collection.name)
+                .order_by(DataObject.name))
+            if after_coll_name is not None:
+                query = query.filter(Collection.name > after_coll_name)
+            return query
+
+        return chain.from_iterable(
+            self.query_results(query, [Collection.name, DataObject.name])
+            for query in self.in_root_collection(query))
 
     def convert_collection_name_to_path(
             self, coll_name, vault_path, zone_name):
         prefix = "/" + zone_name
         return coll_name.replace(prefix, vault_path, 1)
 
-    def check_collections(self, resource_name, resource_hierarchy, vault_path):
-        """Check every collection within the target resource for consistency"""
+    def check_collections(self, resource_name, resource_hierarchy, vault_path,
+                          resume_position=None):
+        """Check every collection within the target resource for consistency.
+        Progress is recorded by collection id."""
 
         resource_interface = self.interface_factory.get_resource_interface(
             resource_name)
 
-        for coll in self.collections_in_root(resource_name):
+        for coll in self.collections_in_root(resource_name, resume_position):
             coll_id = coll[Collection.id]
             coll_name = coll[Collection.name]
-            coll_path = self.convert_collection_name_to_path(
-                coll_name, vault_path, self.session.zone)
-            status_on_disk = resource_interface.check_coll_exists(coll_path)
-            result = Result(obj_type=ObjectType.COLLECTION,
-                            obj_path=coll_name,
-                            phy_path=coll_path,
-                            replica_status="N/A",
-                            status=status_on_disk,
-                            observed_values={},
-                            resource=None)
-            self.formatter(result)
-            if status_on_disk not in [Status.OK, Status.UNKNOWN]:
-                continue
+            if (self.in_shard(coll_name)
+                    and self.check_collection(resource_interface, coll_name,
+                                              resource_hierarchy, vault_path)):
+                for data_object in self.data_objects_in_collection(
+                        coll_id, resource_hierarchy):
+                    phy_path = data_object[DataObject.path]
+                    self.check_object(data_object, resource_name, phy_path)
+            self.record_position(coll_id)
+
+    def check_collections_streamed(self, resource_name, resource_hierarchy, vault_path,
+                                   resume_position=None):
+        """Check every collection within the target resource for consistency,
+        using a single query for all data objects in the resource hierarchy.
+        Collections are derived from the data objects, so collections without
+        data objects in the hierarchy are not reported. Progress is recorded by
+        collection name."""
 
-            print("Checking data objects of collection {} in hierarchy: {}"
-                  .format(coll_name, resource_hierarchy),
-                  file=sys.stderr)
+        resource_interface = self.interface_factory.get_resource_interface(
+            resource_name)
 
-            for data_object in self.data_objects_in_collection(
-                    coll_id, resource_hierarchy):
+        coll_name = None
+        coll_ok = False
+        for data_object in self.data_objects_in_hierarchy(resource_hierarchy,
+                                                          resume_position):
+            if data_object[Collection.name] != coll_name:
+                if coll_name is not None:
+                    self.record_position(coll_name)
+                coll_name = data_object[Collection.name]
+                coll_ok = (self.in_shard(coll_name)
+                           and self.check_collection(resource_interface, coll_name,
+                                                     resource_hierarchy, vault_path))
+            if coll_ok:
                 phy_path = data_object[DataObject.path]
-                result = self.object_checker.get_result(
-                    data_object, resource_name, phy_path, self.no_verify_checksum)
-                self.formatter(result)
+                self.check_object(data_object, resource_name, phy_path)
+
+    def check_collection(self, resource_interface, coll_name,
+                         resource_hierarchy, vault_path):
+        """Check whether the vault directory of a collection exists. Returns
+        whether the data objects in the collection should be checked."""
+        coll_path = self.convert_collection_name_to_path(
+            coll_name, vault_path, self.session.zone)
+        status_on_disk = resource_interface.check_coll_exists(coll_path)
+        result = Result(obj_type=ObjectType.COLLECTION,
+                        obj_path=coll_name,
+                        phy_path=coll_path,
+                        replica_status="N/A",
+                        status=status_on_disk,
+                        observed_values={},
+                        resource=None)
+        self.results.put(result)
+        if status_on_disk not in [Status.OK, Status.UNKNOWN]:
+            return False
+
+        print("Checking data objects of collection {} in hierarchy: {}"
+              .format(coll_name, resource_hierarchy),
+              file=sys.stderr)
+        return True
 
 
 class VaultCheck(Check):
     """Starting from a physical vault path check for consistency"""
 
     def __init__(self, session, fqdn, vault_path,
-                 root_collection, all_local_resources=False, no_verify_checksum=False):
-        super(VaultCheck, self).__init__(session, fqdn, root_collection)
+                 root_collection, all_local_resources=False, no_verify_checksum=False,
+                 catalog_cache_size=100000, path_index=False,
+                 path_index_max_memory=None, walk_threads=1, **options):
+        super(VaultCheck, self).__init__(
+            session, fqdn, root_collection, **options)
+        self.data_object_cache = DataObjectCache(catalog_cache_size)
+        self.use_path_index = path_index
+        self.path_index_max_memory = path_index_max_memory
+        self.path_index = None
+        self.walk_threads = walk_threads
         self.all_local_resources = all_local_resources
         self.no_verify_checksum = no_verify_checksum
         self.vault_path = vault_path
-        self.interface_factory = ResourceInterfaceFactory(session)
 
     def run(self):
         if self.all_local_resources:
 
-            resource_data = self.get_local_ufs_resources(self.fqdn)
-            if resource_data is None:
+            resources = self.get_local_supported_resources(self.fqdn)
+            if not resources:
                 print(
-                    "Error: no local unixfilesystem resources found.",
+                    "Error: no local unixfilesystem or S3 resources found.",
                     file=sys.stderr)
                 sys.exit(1)
-            resources = list(resource_data)
-            resources.sort(key=lambda r: r[Resource.name])
-
-            vault_number = 0
-            for resource in resources:
-                self.process_vault(resource, vault_number == 0)
-                vault_number += 1
         else:
             resource = self.get_resource_from_phy_path(self.vault_path)
             if resource is None:
                 print("Error: unable to find resource with vault path {}.".format(self.vault_path),
                       file=sys.stderr)
                 sys.exit(1)
-            self.process_vault(resource, True)
+            resources = [resource]
+
+        if self.resource_threads > 1:
+            self.write_header()
+            self.run_units([(self.device_of(resource), (resource, False))
+                            for resource in resources],
+                           VaultCheck.process_vault)
+        else:
+            for vault_number, resource in enumerate(resources):
+                self.process_vault(resource, vault_number == 0)
+
+    def unit_check(self, output):
+        unit = super(VaultCheck, self).unit_check(output)
+        unit.data_object_cache = DataObjectCache(self.data_object_cache.max_entries)
+        unit.path_index = None
+        return unit
+
+    def finish_unit(self, unit):
+        super(VaultCheck, self).finish_unit(unit)
+        self.data_object_cache.evictions += unit.data_object_cache.evictions
 
     def process_vault(self, resource, print_header):
         vault_path = resource[Resource.vault_path]
+        resource_name = resource[Resource.name]
+
+        if self.resource_done(resource_name):
+            print("Skipping vault at {}, since it has already been checked"
+                  .format(vault_path), file=sys.stderr)
+            return
 
         print("Checking vault at {} for consistency"
               .format(vault_path),
               file=sys.stderr)
 
         if print_header:
-            self.formatter.head()
+            self.write_header()
 
         if resource is None:
             sys.exit("Error: could not find iRODS resource with vault path {}"
                      .format(vault_path))
 
-        if resource[Resource.type] != "unixfilesystem":
+        if resource[Resource.type] not in ("unixfilesystem", "s3"):
             sys.exit(
-                f"Error: resource {resource[Resource.name]} is not a UFS resource.")
+                f"Error: resource {resource[Resource.name]} is not a UFS or S3 resource.")
 
         root, ancestors = self.find_root(resource)
         hiera = ancestors + [resource[Resource.name]]
@@ -443,74 +960,326 @@ class VaultCheck(Check):
             path_to_walk = self.root_collection.replace(
                 "/" + root[Resource.zone_name], vault_path, 1)
 
-        for dirname, subdirs, filenames in os.walk(path_to_walk):
+        self.start_resource(resource_name)
+        self.start_leaf(resource_name)
+        resume_position = self.resume_position(resource_name, resource_name)
 
-            for subdir in subdirs:
-                phy_path = os.path.join(dirname, subdir)
+        if resource[Resource.type] == "s3":
+            self.check_s3_vault(resource_name, resource_hierarchy,
+                                path_to_walk, resume_position)
+        else:
+            self.check_ufs_vault(resource_name, resource_hierarchy,
+                                 vault_path, path_to_walk, resume_position)
+
+        self.finish_leaf()
+        self.finish_resource()
+
+    def check_ufs_vault(self, resource_name, resource_hierarchy,
+                        vault_path, path_to_walk, resume_position):
+        """Walks the vault of a unixfilesystem resource.
+
+        Progress is recorded as the path of the last completed directory
+        (relative to path_to_walk, as a list of components). Directories are
+        walked in sorted order, so that completed directories can be skipped
+        when resuming."""
+        collections = self.get_collections(resource_name)
+        if self.use_path_index:
+            self.path_index = self.build_path_index(
+                resource_name, resource_hierarchy, path_to_walk)
+        if resume_position is not None:
+            resume_position = tuple(resume_position)
+        prefix = path_to_walk.rstrip(os.sep) + os.sep
+
+        def descend(path):
+            return (self.in_vault_shard(path, prefix, True)
+                    and (resume_position is None
+                         or self.may_contain_unchecked(
+                             self.relative_components(path, path_to_walk), resume_position)))
+
+        current_dir = None
+        for dirname, entry in walk_vault(path_to_walk, descend, self.walk_threads):
+            if dirname != current_dir:
+                current_dir = dirname
+                rel_dir = self.relative_components(dirname, path_to_walk)
+                skip_dir = resume_position is not None and rel_dir <= resume_position
                 coll_name = self.convert_collection_path_to_name(
-                    phy_path, vault_path, self.session.zone)
-                collection, status = self.get_collection(
-                    coll_name, resource[Resource.name])
-                if collection:
-                    obj_path = collection[Collection.name]
-                else:
-                    obj_path = "UNKNOWN"
-                result = Result(
-                    ObjectType.DIRECTORY, obj_path, phy_path, status, "N/A", {}, None)
-
-                self.formatter(result)
-
-            for filename in filenames:
-                phy_path = os.path.join(dirname, filename)
+                    dirname, vault_path, self.session.zone)
+                prefetch = coll_name in collections
+
+            if skip_dir:
+                continue
+            elif entry is None:
+                self.record_position(list(rel_dir))
+            elif not rel_dir and not self.in_vault_shard(entry.path, prefix, entry.is_dir()):
+                continue
+            elif entry.is_dir():
+                self.check_directory(entry.path, vault_path, collections)
+            elif self.file_modified(entry):
+                if prefetch:
+                    self.prefetch_data_objects(coll_name, resource_hierarchy)
+                    prefetch = False
+                self.check_file(entry, resource_name, resource_hierarchy)
+
+        if self.path_index is not None:
+            self.path_index.close()
+            self.path_index = None
+
+    def in_vault_shard(self, phy_path, prefix, is_dir):
+        """Returns whether a vault entry under prefix is part of the shard of
+        this check, if any. Entries are assigned to shards by the name of the
+        top-level directory that they are in. Files directly in the walked
+        directory, and the walked directory itself, have an empty key."""
+        if self.shard is None:
+            return True
+        parts = phy_path[len(prefix):].split(os.sep, 1) if phy_path.startswith(prefix) else []
+        key = parts[0] if len(parts) > 1 or (parts and is_dir) else ""
+        return self.in_shard(key)
+
+    def build_path_index(self, resource_name, resource_hierarchy, path_to_walk):
+        """Returns an index of the physical paths of all replicas under
+        path_to_walk on the resource hierarchy, which is used to find
+        unregistered files without querying the catalog for each of them.
+        The index is sized with a count query, and filled from one streamed
+        query."""
+        def query(*columns):
+            return (self.session.query(*columns)
+                    .filter(DataObject.resc_hier == resource_hierarchy)
+                    .filter(Like(DataObject.path, path_to_walk.rstrip("/") + "/%%")))
+
+        self.statistics.increment("Catalog queries")
+        expected = int(query(DataObject.path).count(DataObject.path).one()[DataObject.path])
+        path_index = PathIndex(expected, max_memory=self.path_index_max_memory)
+        for row in self.query_results(
+                lambda: query(DataObject.id, DataObject.path).order_by(DataObject.id),
+                [DataObject.id]):
+            path_index.add(row[DataObject.path])
+
+        print("Path index of resource {}: {} paths, {:.1f} MiB {}, expected false positive rate {:.2f}%"
+              .format(resource_name, path_index.entries, path_index.nbytes / 2 ** 20,
+                      "in a memory-mapped file" if path_index.spilled else "in memory",
+                      path_index.expected_false_positive_rate() * 100),
+              file=sys.stderr)
+        return path_index
+
+    def check_s3_vault(self, resource_name, resource_hierarchy,
+                       path_to_walk, resume_position):
+        """Lists the objects in the vault of an S3 resource, and merges the
+        listing with the data objects on the resource in the catalog, in
+        order of physical path. The size and ETag in the listing are used
+        for checking the objects, so no HEAD requests are needed.
+
+        Listed objects without a data object on the resource are not
+        registered. They are only looked up individually if the data objects
+        were not all retrieved: in an incremental check, or with a root
+        collection, since data objects in other collections can be stored
+        under the listed path.
+
+        Progress is recorded as the physical path of the last listed object.
+        Data objects that are stored outside of the listed path are checked
+        before the listing."""
+        interface = self.interface_factory.get_resource_interface(resource_name)
+        prefix = path_to_walk.rstrip("/") + "/"
+        catalog = {}
+        elsewhere = []
+        catalog_complete = self.modified_since is None and self.root_collection is None
+
+        for data_object in self.replicas_in_hierarchy(resource_hierarchy):
+            phy_path = data_object[DataObject.path]
+            if not phy_path.startswith(prefix):
+                if self.in_shard(phy_path):
+                    elsewhere.append(data_object)
+            elif ((resume_position is None or phy_path > resume_position)
+                  and self.in_vault_shard(phy_path, prefix, False)):
+                catalog[phy_path] = data_object
+
+        if resume_position is None:
+            for data_object in elsewhere:
+                self.check_object(data_object, resource_name,
+                                  data_object[DataObject.path])
+
+        expected = sorted(catalog)
+        index = 0
+        for phy_path, metadata in interface.list_objects(path_to_walk, resume_position):
+            if not self.in_vault_shard(phy_path, prefix, False):
+                continue
+            while index < len(expected) and expected[index] < phy_path:
+                self.report_missing(catalog[expected[index]])
+                index += 1
+
+            if index < len(expected) and expected[index] == phy_path:
+                data_object = catalog[phy_path]
+                index += 1
+            elif not self.is_modified(metadata["LastModified"].timestamp()):
+                self.record_position(phy_path)
+                continue
+            elif catalog_complete:
+                data_object = None
+            else:
                 data_object, status = self.get_data_object(
                     phy_path, resource_hierarchy)
-                observed_values = {}
-
-                if data_object is None:
-                    obj_path = "UNKNOWN"
-                    result = Result(
-                        ObjectType.FILE,
-                        obj_path,
-                        phy_path,
-                        status,
-                        "N/A",
-                        observed_values,
-                        None)
-                else:
-                    result = self.object_checker.get_result(
-                        data_object, resource[Resource.name], phy_path, self.no_verify_checksum)
-                    # Override object type in Result - should be FILE
-                    result = Result(
-                        ObjectType.FILE,
-                        result.obj_path,
-                        result.phy_path,
-                        result.status,
-                        result.replica_status,
-                        result.observed_values,
-                        result.resource)
-                self.formatter(result)
+
+            if data_object is None:
+                self.results.put(Result(ObjectType.FILE, "UNKNOWN", phy_path,
+                                        Status.NOT_REGISTERED, "N/A", {}, None))
+            else:
+                self.check_object(data_object, resource_name, phy_path,
+                                  ObjectType.FILE, metadata)
+            self.record_position(phy_path)
+
+        for phy_path in expected[index:]:
+            self.report_missing(catalog[phy_path])
+
+    def replicas_in_hierarchy(self, resource_hierarchy, ordered=False):
+        """Returns a generator for the data objects (under the root collection,
+        if set) with a replica on a resource hierarchy. If ordered is set, the
+        data objects are sorted by physical path."""
+        if ordered:
+            resume_key = [DataObject.path, DataObject.id]
+        else:
+            resume_key = [DataObject.id]
+
+        def query():
+            query = self.filter_modified(
+                self.session.query(DataObject, Collection.name, Resource.name)
+                .filter(DataObject.resc_hier == resource_hierarchy))
+            for column in resume_key:
+                query = query.order_by(column)
+            return query
+
+        results = [self.query_results(q, resume_key) for q in self.in_root_collection(query)]
+        if ordered:
+            # The database can sort paths differently than Python (e.g.
+            # because of its collation), so the order is not guaranteed.
+            return heapq.merge(*results, key=lambda row: row[DataObject.path])
+        return chain.from_iterable(results)
+
+    def report_missing(self, data_object, status=Status.NOT_EXISTING):
+        """Reports a data object whose replica is not in the vault"""
+        replica_status = ReplicaStatus(int(data_object[DataObject.replica_status]))
+        self.results.put(Result(ObjectType.DATAOBJECT,
+                                self.object_checker.get_obj_name(data_object),
+                                data_object[DataObject.path], status,
+                                replica_status.name, {}, data_object[Resource.name]))
+
+    def file_modified(self, entry):
+        """Returns whether a file in a vault should be checked by an
+        incremental check, based on its modification time"""
+        if self.modified_since is None:
+            return True
+        try:
+            return self.is_modified(entry.stat().st_mtime)
+        except OSError:
+            # Let the check report the error
+            return True
+
+    def check_directory(self, phy_path, vault_path, collections):
+        coll_name = self.convert_collection_path_to_name(
+            phy_path, vault_path, self.session.zone)
+        if coll_name in collections:
+            obj_path = coll_name
+            status = Status.OK
+        else:
+            obj_path = "UNKNOWN"
+            status = Status.NOT_REGISTERED
+        result = Result(
+            ObjectType.DIRECTORY, obj_path, phy_path, status, "N/A", {}, None)
+
+        self.results.put(result)
+        return status == Status.OK
+
+    def check_file(self, entry, resource_name, resource_hierarchy):
+        """Check a file in a vault, given its os.DirEntry"""
+        phy_path = entry.path
+        data_object, status = self.lookup_data_object(
+            phy_path, resource_hierarchy)
+        observed_values = {}
+
+        if data_object is None:
+            obj_path = "UNKNOWN"
+            result = Result(
+                ObjectType.FILE,
+                obj_path,
+                phy_path,
+                status,
+                "N/A",
+                observed_values,
+                None)
+            self.results.put(result)
+        else:
+            self.check_object(data_object, resource_name,
+                              phy_path, ObjectType.FILE, entry)
+
+    def relative_components(self, path, start):
+        rel_path = os.path.relpath(path, start)
+        return () if rel_path == os.curdir else tuple(rel_path.split(os.sep))
+
+    def may_contain_unchecked(self, rel_dir, resume_position):
+        """Returns whether a directory or its subdirectories come after the
+        resume position in the walk order."""
+        return (rel_dir > resume_position
+                or resume_position[:len(rel_dir)] == rel_dir)
+
+    def close(self):
+        if self.data_object_cache.evictions:
+            self.statistics.increment("Catalog cache evictions",
+                                      self.data_object_cache.evictions)
+        super(VaultCheck, self).close()
 
     def convert_collection_path_to_name(self, phy_path, vault_path, zone_name):
         prefix = '/' + zone_name
         return phy_path.replace(vault_path, prefix, 1)
 
-    def get_collection(self, coll_name, resource_name):
-        try:
-            collection = (
-                self.session.query(Collection, Resource.id)
+    def prefetch_data_objects(self, coll_name, resource_hierarchy):
+        """Adds the data objects in the collection that corresponds to a vault
+        directory to the cache, so that files in the directory can be checked
+        without querying the catalog for each file."""
+        def query():
+            return self.filter_modified(
+                self.session.query(DataObject, Collection.name, Resource.name)
                 .filter(Collection.name == coll_name)
-                .filter(Resource.name == resource_name)
-                .one()
-            )
-        except iexc.NoResultFound:
-            collection = None
-            status = Status.NOT_REGISTERED
-        else:
-            status = Status.OK
+                .filter(DataObject.resc_hier == resource_hierarchy)
+                .order_by(DataObject.id))
+
+        for data_object in self.query_results(query, [DataObject.id]):
+            self.data_object_cache.add(
+                data_object[DataObject.path], data_object)
+
+    def lookup_data_object(self, phy_path, resource_hierarchy):
+        """Looks up the data object of a file in the cache. Falls back to
+        querying the catalog, since the physical path of a data object does
+        not have to match its collection (e.g. after it has been moved), and
+        rows can have been evicted from the cache. Files that are not in the
+        path index (if any) are not registered, so the catalog is not queried
+        for them."""
+        data_object = self.data_object_cache.pop(phy_path)
+        if data_object is not None:
+            self.statistics.increment("Catalog cache hits")
+            return data_object, Status.OK
+
+        if self.path_index is not None and phy_path not in self.path_index:
+            self.statistics.increment("Catalog queries avoided by path index")
+            return None, Status.NOT_REGISTERED
+
+        data_object, status = self.get_data_object(phy_path, resource_hierarchy)
+        if data_object is None and self.path_index is not None:
+            self.statistics.increment("Path index false positives")
+        return data_object, status
+
+    def get_collections(self, resource_name):
+        """Returns an index of the names of all collections (under the root
+        collection, if set) that have data objects on the resource. The index
+        is used to look up the collections of vault directories."""
+        def query():
+            return (self.session.query(Collection.name)
+                    .filter(Resource.name == resource_name)
+                    .order_by(Collection.name))
 
-        return collection, status
+        return CollectionIndex(row[Collection.name]
+                               for query in self.in_root_collection(query)
+                               for row in self.query_results(query, [Collection.name]))
 
     def get_data_object(self, phy_path, resource_hierarchy):
+        self.statistics.increment("Catalog queries")
         try:
             result = (
                 self.session.query(DataObject, Collection.name, Resource.name)
@@ -531,20 +1300,142 @@ class VaultCheck(Check):
         return data_object, status
 
 
+class ReconcileCheck(VaultCheck):
+    """Checks the files in a vault and the data objects on its resource in a
+    single pass. The vault is walked in sorted order and merged with the
+    replicas in the catalog, sorted by physical path, so that the results of
+    both vault mode and resource mode are reported."""
+
+    def check_ufs_vault(self, resource_name, resource_hierarchy,
+                        vault_path, path_to_walk, resume_position):
+        """Merges the walk of a unixfilesystem vault with the replicas on
+        the resource.
+
+        Replicas that come before the current file in the walk are not in
+        the vault, unless the catalog returned them out of order. They are
+        checked for existence, and reported if the file is missing. Files
+        without a replica at the same position are looked up individually.
+        Replicas outside of the walked directory (e.g. moved data objects)
+        are checked separately. Collections on the resource are merged with
+        the walk in the same way, and reported if the walk passed their
+        directory without finding it.
+
+        Progress is recorded as the walk key of the last checked entry, and
+        the number of checked replicas outside of the walked directory."""
+        interface = self.interface_factory.get_resource_interface(resource_name)
+        collections = self.get_collections(resource_name)
+        prefix = path_to_walk.rstrip(os.sep) + os.sep
+
+        if resume_position is None:
+            last_key, resume_elsewhere = None, 0
+        else:
+            last_key, resume_elsewhere = resume_position
+
+        rows = self.replicas_in_hierarchy(resource_hierarchy, ordered=True)
+        pending = next(rows, None)
+        elsewhere = 0
+        expected_dirs = self.collections_in_walk_order(
+            collections, vault_path, path_to_walk, last_key)
+        found_dirs = set()
+        walked = False
+
+        def check_replicas_before(key):
+            nonlocal pending, elsewhere
+            while pending is not None and (key is None or pending[DataObject.path] < key):
+                phy_path = pending[DataObject.path]
+                if not phy_path.startswith(prefix):
+                    elsewhere += 1
+                    if elsewhere > resume_elsewhere and self.in_shard(phy_path):
+                        self.check_object(pending, resource_name, phy_path)
+                elif ((last_key is None or phy_path > last_key)
+                      and self.in_vault_shard(phy_path, prefix, False)):
+                    status = interface.check_object_exists(phy_path)
+                    if status != Status.OK:
+                        self.report_missing(pending, status)
+                pending = next(rows, None)
+
+            while expected_dirs and (key is None or expected_dirs[-1][0] < key):
+                _, coll_name, coll_path = expected_dirs.pop()
+                if coll_name not in found_dirs:
+                    self.results.put(Result(ObjectType.COLLECTION, coll_name, coll_path,
+                                            Status.NOT_EXISTING, "N/A", {}, None))
+
+        def descend(path):
+            key = walk_key(path, True)
+            return (self.in_vault_shard(path, prefix, True)
+                    and (last_key is None or key > last_key or last_key.startswith(key)))
+
+        for dirname, entry, is_dir in walk_vault_in_order(path_to_walk, descend,
+                                                          self.walk_threads):
+            if entry is None:
+                continue
+            walked = True
+            key = walk_key(entry.path, is_dir)
+            if last_key is not None and key <= last_key:
+                continue
+            if not self.in_vault_shard(entry.path, prefix, is_dir):
+                continue
+
+            check_replicas_before(key)
+            if is_dir:
+                if self.check_directory(entry.path, vault_path, collections):
+                    found_dirs.add(self.convert_collection_path_to_name(
+                        entry.path, vault_path, self.session.zone))
+            else:
+                matched = False
+                while pending is not None and pending[DataObject.path] == entry.path:
+                    self.check_object(pending, resource_name, entry.path,
+                                      ObjectType.FILE, entry)
+                    matched = True
+                    pending = next(rows, None)
+                if not matched:
+                    self.check_file(entry, resource_name, resource_hierarchy)
+            self.record_position([key, elsewhere])
+
+        check_replicas_before(None)
+        top_name = self.convert_collection_path_to_name(
+            path_to_walk.rstrip(os.sep), vault_path, self.session.zone)
+        if last_key is None and not walked and top_name in collections:
+            # The walk yields no entries for an empty or a missing directory
+            status = interface.check_coll_exists(path_to_walk)
+            if status != Status.OK:
+                self.results.put(Result(ObjectType.COLLECTION, top_name, path_to_walk,
+                                        status, "N/A", {}, None))
+
+    def collections_in_walk_order(self, collections, vault_path, path_to_walk, last_key):
+        """Returns the walk keys, names and vault paths of the collections
+        whose directories are below path_to_walk and after last_key in the
+        walk, sorted in reverse walk order"""
+        prefix = path_to_walk.rstrip(os.sep) + os.sep
+        expected = []
+        for coll_name in collections:
+            coll_path = coll_name.replace("/" + self.session.zone, vault_path, 1)
+            key = walk_key(coll_path, True)
+            if (coll_path.startswith(prefix)
+                    and (last_key is None or key > last_key)
+                    and self.in_vault_shard(coll_path, prefix, True)):
+                expected.append((key, coll_name, coll_path))
+        expected.sort(reverse=True)
+        return expected
+
+
 class ObjectListCheck(Check):
-    """Check all local replicas of a list of objects"""
+    """Check all local replicas of a list of objects. The list is read in
+    batches, so that the data objects can be looked up with few queries."""
+
+    BATCH_SIZE = 1000
+    MAX_NAMES_LENGTH = 2000
 
     def __init__(self, session, fqdn, object_list_file,
-                 no_verify_checksum=False):
-        super(ObjectListCheck, self).__init__(session, fqdn, None)
+                 no_verify_checksum=False, **options):
+        super(ObjectListCheck, self).__init__(session, fqdn, None, **options)
         self.object_list_file = object_list_file
         self.no_verify_checksum = no_verify_checksum
         self.resource_locality_lookup = self._gen_resource_locality_lookup()
 
     def _gen_resource_locality_lookup(self):
         result = {}
-        resources = self.session.query(Resource.name, Resource.location)
-        for resource in resources:
+        for resource in self.resource_graph.resources:
             result[resource[Resource.name]
                    ] = resource[Resource.location] == self.fqdn
         return result
@@ -552,50 +1443,113 @@ class ObjectListCheck(Check):
     def _is_local_resource(self, resource_name):
         return self.resource_locality_lookup[resource_name]
 
-    def _check_object(self, object_name):
-
-        def _not_found():
+    def _name_groups(self, names):
+        """Splits data object names into groups for queries with an In
+        condition, with a limited total length. Names that contain a quote
+        can't be used in an In condition, and get a group of their own."""
+        group = []
+        length = 0
+        for name in sorted(names):
+            if "'" in name:
+                yield [name]
+                continue
+            if group and length + len(name) + 3 > self.MAX_NAMES_LENGTH:
+                yield group
+                group = []
+                length = 0
+            group.append(name)
+            length += len(name) + 3
+        if group:
+            yield group
+
+    def _objects_query(self, coll_name, names):
+        """Returns a query for the replicas of data objects in a collection"""
+        query = (self.session.query(DataObject, Collection.name, Resource.name)
+                 .filter(Collection.name == coll_name)
+                 .order_by(DataObject.id)
+                 .order_by(DataObject.replica_number))
+        if len(names) == 1:
+            return query.filter(DataObject.name == names[0])
+        return query.filter(In(DataObject.name, names))
+
+    def _lookup_objects(self, object_names):
+        """Looks up the replicas of a batch of data objects. The objects are
+        grouped by collection, and the objects of a collection are looked up
+        with queries for multiple names at a time.
+
+        :returns: dict from (collection name, data object name) to the
+                  replicas of the data object, ordered by replica number"""
+        names_by_collection = {}
+        for object_name in object_names:
+            names_by_collection.setdefault(
+                irods_dirname(object_name), set()).add(irods_basename(object_name))
+
+        replicas = {}
+        for coll_name, names in names_by_collection.items():
+            for group in self._name_groups(names):
+                for data_object in self.query_results(
+                        partial(self._objects_query, coll_name, group),
+                        [DataObject.id, DataObject.replica_number]):
+                    replicas.setdefault((coll_name, data_object[DataObject.name]),
+                                        []).append(data_object)
+
+        for data_objects in replicas.values():
+            data_objects.sort(key=lambda data_object: data_object[DataObject.replica_number])
+        return replicas
+
+    def _check_object(self, object_name, data_objects):
+        """Schedules checks of all local replicas of a data object"""
+        if not data_objects:
             result = Result(ObjectType.DATAOBJECT, object_name,
                             "", Status.NOT_FOUND, "N/A", {}, None)
-            self.formatter(result)
+            self.results.put(result)
             return
 
-        try:
-            collection = self.session.collections.get(
-                irods_dirname(object_name))
-            objects = self.session.query(DataObject, Collection.name, Resource.name).filter(
-                DataObject.name == irods_basename(object_name)).filter(
-                DataObject.collection_id == collection.id).all()
-        except (iexc.NoResultFound, iexc.CollectionDoesNotExist):
-            _not_found()
-            return
-
-        if len(objects) == 0:
-            _not_found()
-            return
+        if self.modified_since is not None:
+            data_objects = [object for object in data_objects
+                            if self.is_modified(object[DataObject.modify_time].timestamp())]
+            if not data_objects:
+                return
 
-        results_found = False
+        local_objects = [object for object in data_objects
+                         if self._is_local_resource(object[DataObject.resource_name])]
 
-        for object in objects:
-            if self._is_local_resource(object[DataObject.resource_name]):
-                result = self.object_checker.get_result(object,
-                                                        object[DataObject.resource_name],
-                                                        object[DataObject.path],
-                                                        self.no_verify_checksum)
-                results_found = True
+        for object in local_objects:
+            self.check_object(object,
+                              object[DataObject.resource_name],
+                              object[DataObject.path])
 
-        if not results_found:
+        if not local_objects:
             result = Result(ObjectType.DATAOBJECT, object_name,
                             "", Status.NO_LOCAL_REPLICA, "N/A", {}, None)
+            self.results.put(result)
 
-        self.formatter(result)
+    def _check_batch(self, object_names):
+        """Checks a batch of data objects, in the order of the list"""
+        replicas = self._lookup_objects(object_names)
+        for object_name in object_names:
+            self._check_object(object_name, replicas.get(
+                (irods_dirname(object_name), irods_basename(object_name)), []))
 
     def run(self):
         print("Checking object list {} for consistency of local replicas"
               .format(self.object_list_file.name),
               file=sys.stderr)
 
-        self.formatter.head()
+        self.write_header()
+
+        resume_position = self.resume_position(None, None) or 0
 
-        for line in self.object_list_file:
-            self._check_object(line.rstrip('\n'))
+        batch = []
+        line_number = resume_position
+        for line_number, line in enumerate(self.object_list_file, start=1):
+            if line_number <= resume_position:
+                continue
+            if self.in_shard(line_number):
+                batch.append(line.rstrip('\n'))
+            if len(batch) == self.BATCH_SIZE:
+                self._check_batch(batch)
+                batch = []
+                self.record_position(line_number)
+        self._check_batch(batch)
+        self.record_position(line_number)
@@ -0,0 +1,114 @@
+"""Persistent cache of checksums of files in unixfilesystem vaults"""
+
+import os
+import sqlite3
+import time
+from threading import Lock
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class ChecksumCache(object):
+    """Cache of file checksums, stored in a SQLite database.
+
+    Entries are keyed on the device, inode, size and modification time of the
+    file, as well as the checksum type, so a file that has been modified
+    is hashed again. Since hard links to a file share these attributes, a file
+    with several links is only hashed once.
+
+    :param path: path of the SQLite database
+    :param max_age: entries older than this number of days are removed
+    :param max_entries: if the cache has more entries, the oldest ones are removed
+    :param recheck_older_than: entries older than this number of days are not used,
+                               so that files are hashed again periodically to detect
+                               bit rot. Entries added during the current run are
+                               always used."""
+
+    DEFAULT_PATH = os.path.join("~", ".cache", "ichk", "checksums.sqlite")
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path, max_age=None, max_entries=None,
+                 recheck_older_than=None):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.recheck_older_than = recheck_older_than
+        self.run_started = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS checksums (
+                   device INTEGER NOT NULL,
+                   inode INTEGER NOT NULL,
+                   size INTEGER NOT NULL,
+                   mtime_ns INTEGER NOT NULL,
+                   checksum_type TEXT NOT NULL,
+                   checksum TEXT NOT NULL,
+                   hashed_at REAL NOT NULL,
+                   PRIMARY KEY (device, inode, size, mtime_ns, checksum_type))""")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS checksums_hashed_at ON checksums (hashed_at)")
+        self.evict()
+
+    def _key(self, stat_result, checksum_type):
+        return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+                stat_result.st_mtime_ns, checksum_type)
+
+    def get(self, stat_result, checksum_type):
+        """Returns the cached checksum of a file, or None if the cache does
+        not have a valid entry for it."""
+        with self.lock:
+            row = self.connection.execute(
+                """SELECT checksum, hashed_at FROM checksums
+                   WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?
+                   AND checksum_type = ?""",
+                self._key(stat_result, checksum_type)).fetchone()
+
+            if row is not None:
+                checksum, hashed_at = row
+                if (self.recheck_older_than is None
+                        or hashed_at >= self.run_started
+                        or hashed_at >= time.time() - self.recheck_older_than * SECONDS_PER_DAY):
+                    self.hits += 1
+                    return checksum
+
+            self.misses += 1
+            return None
+
+    def put(self, stat_result, checksum_type, checksum):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._key(stat_result, checksum_type) + (checksum, time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= ChecksumCache.COMMIT_INTERVAL:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def evict(self):
+        """Removes entries that are older than the maximum age, as well as the
+        oldest entries if the cache has more than the maximum number of entries."""
+        with self.lock:
+            if self.max_age is not None:
+                self.connection.execute(
+                    "DELETE FROM checksums WHERE hashed_at < ?",
+                    (time.time() - self.max_age * SECONDS_PER_DAY,))
+            if self.max_entries is not None:
+                self.connection.execute(
+                    """DELETE FROM checksums WHERE rowid IN (
+                           SELECT rowid FROM checksums ORDER BY hashed_at
+                           LIMIT max(0, (SELECT count(*) FROM checksums) - ?))""",
+                    (self.max_entries,))
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.connection.close()
@@ -3,8 +3,11 @@
 import argparse
 import json
 import os
+import signal
 import socket
 import sys
+import time
+from datetime import datetime
 from getpass import getpass
 
 from irods import password_obfuscation
@@ -12,6 +15,12 @@ from irods.message import (ET, XML_Parser_Type)
 from irods.session import iRODSSession
 
 from ichk import check
+from ichk.checksum_cache import ChecksumCache
+from ichk.concurrency import ConcurrencyController
+from ichk.rate_limiter import RateLimiter
+from ichk.scan_state import ScanState
+from ichk.session_pool import SessionPool
+from ichk.shard import Shard
 
 
 def entry():
@@ -37,10 +46,10 @@ def get_args():
                            type=argparse.FileType('r'),
                            help="Check replicas of a list of data objects on this server.")
     scan_type.add_argument("--all-local-resources", action="store_true", default=False,
-                           help="Scan all unixfilesystem resources on this server")
+                           help="Scan all unixfilesystem and S3 resources on this server")
     scan_type.add_argument("--all-local-vaults", action="store_true", default=False,
-                           help="Scan all vaults of unixfilesystem resources on this server")
-    parser.add_argument("-o", "--output", type=argparse.FileType('w'),
+                           help="Scan all vaults of unixfilesystem and S3 resources on this server")
+    parser.add_argument("-o", "--output",
                         help="Write output to file")
     parser.add_argument("-m", "--format", dest="fmt", default='human',
                         help="Output format", choices=['human', 'csv'])
@@ -51,10 +60,100 @@ def get_args():
     parser.add_argument("-T", "--timeout", default=10 * 60, type=int,
                         help="Sets the maximum amount of seconds to wait for server responses"
                         + ", default 600. Increase this to account for longer-running queries.")
+    parser.add_argument("--query-retries", default=5, type=int, metavar="N",
+                        help="Number of times a catalog query is retried after a network error or timeout, "
+                        + "with an exponentially increasing delay, default 5. Retried queries continue "
+                        + "after the last result that was received.")
     parser.add_argument("-s", "--root-collection", dest='root_collection', default=None,
                         help="Only check a particular collection and its subcollections.")
     parser.add_argument("--no-verify-checksum", action="store_true", default=False,
                         help="Do not verify checksums of data objects. Just check presence and size of vault files.")
+    parser.add_argument("--force-download-verify", action="store_true", default=False,
+                        help="Download S3 objects to verify their MD5 checksum, even if the ETag of the object "
+                        + "is an MD5 checksum.")
+    parser.add_argument("--s3-download-threads", default=4, type=int, metavar="N",
+                        help="Number of byte ranges of a large S3 object to download concurrently, default 4.")
+    parser.add_argument("--s3-max-connections", default=None, type=int, metavar="N",
+                        help="Maximum number of connections to an S3 endpoint. By default, this is the number "
+                        + "of workers times the number of S3 download threads, with a minimum of 10.")
+    parser.add_argument("-w", "--workers", default=1, type=int,
+                        help="Number of worker threads for checking replicas, default 1. "
+                        + "Output is written in the same order regardless of this setting.")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="Check replicas in a pipeline with separate stages for metadata (existence and size) "
+                        + "and checksums, so that both overlap. The checksum stage uses --workers threads.")
+    parser.add_argument("--metadata-workers", default=4, type=int, metavar="N",
+                        help="Number of threads of the metadata stage of --pipeline, default 4.")
+    parser.add_argument("--resource-threads", default=1, type=int, metavar="N",
+                        help="Number of leaf resources (resource mode) or vaults (vault mode) to check "
+                        + "concurrently, default 1. Output is written in the same order regardless of this setting.")
+    parser.add_argument("--sessions", default=None, type=int, metavar="N",
+                        help="Maximum number of additional iRODS sessions for catalog queries of leaf resources or "
+                        + "vaults that are checked concurrently. By default, this is the number of resource threads.")
+    parser.add_argument("--per-device", default=1, type=int, metavar="N",
+                        help="Maximum number of unixfilesystem vaults on the same block device to check "
+                        + "concurrently, default 1.")
+    parser.add_argument("--auto-tune", action="store_true", default=False,
+                        help="Adjust the number of concurrent catalog queries, metadata operations and reads while "
+                        + "the check runs, based on their throughput and latency. The numbers of workers, metadata "
+                        + "workers and sessions are the maximums.")
+    parser.add_argument("--locality-window", default=0, type=int, metavar="N",
+                        help="Collect up to N pending checks of files in unixfilesystem vaults and hash them in "
+                        + "order of their location on disk, so that disks seek less. Disabled by default.")
+    parser.add_argument("--locality-order", default="inode", choices=["inode", "extent"],
+                        help="Location of files for --locality-window: the inode number (default), or the physical "
+                        + "offset of the first extent of the file, if the file system supports FIEMAP.")
+    parser.add_argument("--checksum-cache", nargs="?", const=ChecksumCache.DEFAULT_PATH, default=None,
+                        metavar="PATH",
+                        help="Cache checksums of unchanged files in vaults in a local database "
+                        + "(default path: {}).".format(ChecksumCache.DEFAULT_PATH))
+    parser.add_argument("--checksum-cache-max-age", type=float, default=90, metavar="DAYS",
+                        help="Remove checksum cache entries older than this number of days, default 90.")
+    parser.add_argument("--checksum-cache-max-entries", type=int, default=10000000, metavar="N",
+                        help="Maximum number of entries in the checksum cache, default 10000000.")
+    parser.add_argument("--recheck-older-than", type=float, default=None, metavar="DAYS",
+                        help="Hash files again if their checksum cache entry is older than this number of days.")
+    parser.add_argument("--stream-catalog", action="store_true", default=False,
+                        help="Resource mode: retrieve all data objects of a resource hierarchy with a single query, "
+                        + "rather than with a query per collection.")
+    parser.add_argument("--reconcile", action="store_true", default=False,
+                        help="Vault mode: also check the data objects on the resource, like resource mode, "
+                        + "in the same pass over the vault.")
+    parser.add_argument("--catalog-cache-size", default=100000, type=int,
+                        help="Maximum number of data object records to cache in vault mode, default 100000.")
+    parser.add_argument("--walk-threads", default=1, type=int, metavar="N",
+                        help="Vault mode: number of threads for reading directories of unixfilesystem vaults, "
+                        + "default 1. More threads help on network file systems, such as NFS or GPFS.")
+    parser.add_argument("--path-index", action="store_true", default=False,
+                        help="Vault mode: load the physical paths of all replicas on the resource into a compact "
+                        + "index, so that unregistered files can be found without querying the catalog for each file.")
+    parser.add_argument("--path-index-max-memory", default=1024, type=int, metavar="MIB",
+                        help="Maximum size of the path index in memory, default 1024 MiB. "
+                        + "Larger indexes are stored in a memory-mapped temporary file.")
+    parser.add_argument("--shard", default=None, type=parse_shard, metavar="K/N",
+                        help="Only check part K of N of the collections (resource mode), top-level directories "
+                        + "(vault mode) or lines (object list mode), e.g. 1/4. Use ichk-merge to combine the "
+                        + "CSV output of all shards.")
+    parser.add_argument("--modified-since", default=None, type=parse_timestamp, metavar="TIMESTAMP",
+                        help="Only check data objects and vault files that were modified since a time, given as "
+                        + "an ISO 8601 date and time (e.g. 2024-05-01T00:00) or as seconds since the epoch.")
+    parser.add_argument("--since-last-run", action="store_true", default=False,
+                        help="Only check data objects and vault files that were modified since the start of the "
+                        + "last completed scan in the state file.")
+    parser.add_argument("--state-file", default=None,
+                        help="Periodically save the progress of the scan to this file, so that it can be resumed.")
+    parser.add_argument("--state-interval", default=60, type=int, metavar="SECONDS",
+                        help="Minimum number of seconds between saves of the state file, default 60.")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Resume an interrupted scan from the state file, appending to the output file.")
+    parser.add_argument("--max-read-rate", type=float, default=None, metavar="BYTES",
+                        help="Maximum number of bytes per second to read from resources.")
+    parser.add_argument("--max-ops-rate", type=float, default=None, metavar="OPS",
+                        help="Maximum number of metadata operations (e.g. stat calls or S3 HEAD requests) "
+                        + "per second on resources.")
+    parser.add_argument("--rate-control-file", default=None, metavar="PATH",
+                        help="JSON file with max_read_rate and max_ops_rate values that override the rate limits. "
+                        + "The file is read again when it changes, or when ichk receives a SIGHUP signal.")
     parser.add_argument("-q", "--quasi-xml", action="store_true", default=False,
                         help="Enable the Quasi-XML parser, which supports unusual characters (0x01-0x31, backticks)")
     args = parser.parse_args()
@@ -63,12 +162,117 @@ def get_args():
         print("Error: the --root-collection / -s and the --data-object-list / -l option can't be combined.")
         sys.exit(1)
 
+    if args.workers < 1:
+        print("Error: the number of workers must be at least 1.")
+        sys.exit(1)
+
+    if args.resource_threads < 1 or args.per_device < 1:
+        print("Error: the number of resource threads and vaults per device must be at least 1.")
+        sys.exit(1)
+
+    if args.query_retries < 0:
+        print("Error: the number of query retries can't be negative.")
+        sys.exit(1)
+
+    if args.sessions is not None and args.sessions < 1:
+        print("Error: the number of sessions must be at least 1.")
+        sys.exit(1)
+
+    if args.resource_threads > 1 and args.state_file is not None:
+        print("Error: the --resource-threads option can't be combined with the --state-file option.")
+        sys.exit(1)
+
+    if args.locality_window < 0:
+        print("Error: the locality window can't be negative.")
+        sys.exit(1)
+
+    if args.metadata_workers < 1:
+        print("Error: the number of metadata workers must be at least 1.")
+        sys.exit(1)
+
+    if args.pipeline and args.locality_window:
+        print("Error: the --pipeline and --locality-window options can't be combined.")
+        sys.exit(1)
+
+    if args.auto_tune and args.workers == 1 and args.resource_threads == 1 and not args.pipeline:
+        print("Error: the --auto-tune option needs more than one worker, resource thread or the --pipeline option.")
+        sys.exit(1)
+
+    if args.s3_download_threads < 1 or (args.s3_max_connections is not None
+                                        and args.s3_max_connections < 1):
+        print("Error: the number of S3 download threads and connections must be at least 1.")
+        sys.exit(1)
+
+    if args.checksum_cache is None and args.recheck_older_than is not None:
+        print("Error: the --recheck-older-than option requires the --checksum-cache option.")
+        sys.exit(1)
+
+    if args.catalog_cache_size < 1:
+        print("Error: the catalog cache size must be at least 1.")
+        sys.exit(1)
+
+    if ((args.max_read_rate is not None and args.max_read_rate <= 0)
+            or (args.max_ops_rate is not None and args.max_ops_rate <= 0)):
+        print("Error: rate limits must be greater than 0.")
+        sys.exit(1)
+
+    if args.reconcile and not (args.vault or args.all_local_vaults):
+        print("Error: the --reconcile option can only be used in vault mode.")
+        sys.exit(1)
+
+    if args.walk_threads < 1:
+        print("Error: the number of walk threads must be at least 1.")
+        sys.exit(1)
+
+    if args.walk_threads > 1 and not (args.vault or args.all_local_vaults):
+        print("Error: the --walk-threads option can only be used in vault mode.")
+        sys.exit(1)
+
+    if args.path_index and (args.reconcile or not (args.vault or args.all_local_vaults)):
+        print("Error: the --path-index option can only be used in vault mode, without --reconcile.")
+        sys.exit(1)
+
+    if args.modified_since is not None and args.since_last_run:
+        print("Error: the --modified-since and --since-last-run options can't be combined.")
+        sys.exit(1)
+
+    if args.since_last_run and args.state_file is None:
+        print("Error: the --since-last-run option requires the --state-file option.")
+        sys.exit(1)
+
+    if args.reconcile and (args.modified_since is not None or args.since_last_run):
+        print("Error: the --reconcile option can't be combined with incremental checks.")
+        sys.exit(1)
+
+    if args.resume and (args.state_file is None or args.output is None):
+        print("Error: the --resume option requires the --state-file and --output options.")
+        sys.exit(1)
+
     if args.root_collection is not None:
         args.root_collection = args.root_collection.rstrip("/")
 
     return args
 
 
+def parse_shard(spec):
+    try:
+        return Shard.parse(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_timestamp(value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected an ISO 8601 date and time, or seconds since the epoch")
+
+
 def main(args):
     session = setup_session()
     session.connection_timeout = args.timeout
@@ -116,33 +320,207 @@ def setup_session():
     return session
 
 
+def get_scan_description(args):
+    '''Returns the parameters that identify a scan in its state file'''
+    if args.data_object_list_file is not None:
+        data_object_list = os.path.abspath(args.data_object_list_file.name)
+    else:
+        data_object_list = None
+
+    return {"fqdn": args.fqdn,
+            "resource": args.resource,
+            "vault": args.vault,
+            "data_object_list": data_object_list,
+            "all_local_resources": args.all_local_resources,
+            "all_local_vaults": args.all_local_vaults,
+            "root_collection": args.root_collection,
+            "stream_catalog": args.stream_catalog,
+            "reconcile": args.reconcile,
+            "shard": None if args.shard is None else str(args.shard),
+            "format": args.fmt,
+            "output": os.path.abspath(args.output) if args.output else None}
+
+
+def get_scan_state(args):
+    '''Returns the state of the scan, and the saved state of an interrupted
+    run if it should be resumed. The start time of the last completed scan is
+    carried over from the state file by every run, so that a run that is
+    interrupted doesn't discard it.'''
+    if args.state_file is None:
+        return None, None
+
+    state = ScanState(args.state_file, get_scan_description(args),
+                      args.state_interval)
+    resume_data = None
+
+    try:
+        data = state.load()
+        if args.resume and state.resumable_progress(data) is not None:
+            resume_data = data
+        state.last_completed_started = state.last_completed_start(data)
+    except ValueError as e:
+        # A new full scan can overwrite the state of other scans
+        if args.resume or args.since_last_run:
+            print("Error: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+
+    if args.resume and resume_data is None:
+        print("No interrupted scan found in {}, starting a new scan."
+              .format(args.state_file), file=sys.stderr)
+
+    return state, resume_data
+
+
+def get_modified_since(args, state, resume_data):
+    '''Returns the time since which data objects and files must have been
+    modified to be checked, or None for a full check'''
+    if resume_data is not None:
+        return resume_data.get("modified_since")
+
+    if args.since_last_run:
+        if state.last_completed_started is None:
+            print("No completed scan found in {}, checking everything."
+                  .format(args.state_file), file=sys.stderr)
+            return None
+        print("Checking changes since the last completed scan, which started at {}."
+              .format(time.ctime(state.last_completed_started)), file=sys.stderr)
+        return state.last_completed_started
+
+    return args.modified_since
+
+
+def open_output(args, resume_data):
+    '''Opens the output file. When resuming, output written after the last
+    save of the state is discarded, so that no results are duplicated.'''
+    if args.output is None:
+        return sys.stdout
+
+    if (resume_data is not None and resume_data["output_offset"] is not None
+            and os.path.exists(args.output)):
+        output = open(args.output, "r+")
+        output.seek(resume_data["output_offset"])
+        output.truncate()
+        return output
+
+    return open(args.output, "w")
+
+
+def get_rate_limiter(args):
+    '''Returns the rate limiter of the check, or None if there are no limits'''
+    if (args.max_read_rate is None and args.max_ops_rate is None
+            and args.rate_control_file is None):
+        return None
+
+    rate_limiter = RateLimiter(args.max_read_rate, args.max_ops_rate,
+                               args.rate_control_file)
+
+    if args.rate_control_file is not None and hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: rate_limiter.request_reload())
+
+    return rate_limiter
+
+
+def get_concurrency_controller(args):
+    '''Returns the adaptive concurrency limits of the check, or None if
+    they are not enabled'''
+    if not args.auto_tune:
+        return None
+
+    workers = args.workers * args.resource_threads
+    metadata_workers = args.metadata_workers * args.resource_threads if args.pipeline else workers
+    return ConcurrencyController(catalog=args.sessions or args.resource_threads,
+                                 stat=metadata_workers, read=workers)
+
+
+def get_s3_options(args):
+    '''Returns the options of S3 resource interfaces'''
+    if args.s3_max_connections is None:
+        max_connections = max(10, args.workers * args.s3_download_threads)
+    else:
+        max_connections = args.s3_max_connections
+
+    return {'force_download_verify': args.force_download_verify,
+            'max_connections': max_connections,
+            'download_threads': args.s3_download_threads}
+
+
 def run(session, args):
     '''Actually runs the check'''
+    state, resume_data = get_scan_state(args)
+    output = open_output(args, resume_data)
+
+    if args.checksum_cache is not None:
+        checksum_cache = ChecksumCache(
+            args.checksum_cache,
+            max_age=args.checksum_cache_max_age,
+            max_entries=args.checksum_cache_max_entries,
+            recheck_older_than=args.recheck_older_than)
+    else:
+        checksum_cache = None
+
+    session_pool = SessionPool(session, args.sessions or args.resource_threads)
+
+    check_options = {'workers': args.workers,
+                     'checksum_cache': checksum_cache,
+                     'state': state,
+                     'resume_data': resume_data,
+                     'rate_limiter': get_rate_limiter(args),
+                     's3_options': get_s3_options(args),
+                     'shard': args.shard,
+                     'resource_threads': args.resource_threads,
+                     'per_device': args.per_device,
+                     'locality_window': args.locality_window,
+                     'locality_order': args.locality_order,
+                     'modified_since': get_modified_since(args, state, resume_data),
+                     'pipeline': args.pipeline,
+                     'metadata_workers': args.metadata_workers,
+                     'session_pool': session_pool,
+                     'query_retries': args.query_retries,
+                     'concurrency': get_concurrency_controller(args)}
+
+    vault_check = check.ReconcileCheck if args.reconcile else check.VaultCheck
+
     if args.resource:
         executor = check.ResourceCheck(
             session, args.fqdn, args.resource, args.root_collection,
-            all_local_resources=False, no_verify_checksum=args.no_verify_checksum)
+            all_local_resources=False, no_verify_checksum=args.no_verify_checksum,
+            stream_catalog=args.stream_catalog,
+            **check_options)
     elif args.vault:
-        executor = check.VaultCheck(
+        executor = vault_check(
             session, args.fqdn, args.vault, args.root_collection,
-            all_local_resources=False, no_verify_checksum=args.no_verify_checksum)
+            all_local_resources=False, no_verify_checksum=args.no_verify_checksum,
+            catalog_cache_size=args.catalog_cache_size,
+            path_index=args.path_index,
+            path_index_max_memory=args.path_index_max_memory * 2 ** 20,
+            walk_threads=args.walk_threads,
+            **check_options)
     elif args.all_local_resources:
         executor = check.ResourceCheck(
             session, args.fqdn, None, args.root_collection,
-            all_local_resources=True, no_verify_checksum=args.no_verify_checksum)
+            all_local_resources=True, no_verify_checksum=args.no_verify_checksum,
+            stream_catalog=args.stream_catalog,
+            **check_options)
     elif args.all_local_vaults:
-        executor = check.VaultCheck(
+        executor = vault_check(
             session, args.fqdn, None, args.root_collection,
-            all_local_resources=True, no_verify_checksum=args.no_verify_checksum)
+            all_local_resources=True, no_verify_checksum=args.no_verify_checksum,
+            catalog_cache_size=args.catalog_cache_size,
+            path_index=args.path_index,
+            path_index_max_memory=args.path_index_max_memory * 2 ** 20,
+            walk_threads=args.walk_threads,
+            **check_options)
     elif args.data_object_list_file:
         executor = check.ObjectListCheck(
             session, args.fqdn, args.data_object_list_file,
-            no_verify_checksum=args.no_verify_checksum)
+            no_verify_checksum=args.no_verify_checksum,
+            **check_options)
     else:
         print("Error: unknown check type.", file=sys.stderr)
         sys.exit(1)
 
-    options = {'output': args.output or sys.stdout,
+    options = {'output': output,
                'fmt': args.fmt,
                "checksum_format": args.checksum_format}
     if args.truncate:
@@ -151,3 +529,11 @@ def run(session, args):
     executor.setformatter(**options)
 
     executor.run()
+    executor.close()
+    session_pool.close()
+
+    if output is not sys.stdout:
+        output.close()
+
+    if checksum_cache is not None:
+        checksum_cache.close()
@@ -0,0 +1,172 @@
+"""Adaptive limits on the concurrency of the stages of a check"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+
+
+class AdaptiveLimit(object):
+    """Limit on the number of threads that run a stage of a check (e.g.
+    reading files) at the same time, which is adjusted while the check runs
+    by an AIMD (additive increase, multiplicative decrease) controller.
+
+    At the end of each interval, the throughput and the latency per unit
+    (e.g. per byte read) of the interval are computed. The latency is the
+    average number of running operations divided by the throughput, which,
+    unlike the duration of the operations that have completed, includes the
+    time of operations that are still waiting for a busy device. If the
+    latency is more than TOLERANCE times the lowest latency of the last
+    HISTORY intervals, the stage is congested (e.g. a disk that is seeking
+    between too many files) and the limit is halved.
+    Otherwise, if operations had to wait for the limit during the interval,
+    the limit is increased by one, up to maximum.
+
+    :param name: name of the stage
+    :param maximum: number of threads that can run the stage
+    :param unit: unit of the amounts of the operations, e.g. bytes"""
+
+    INTERVAL = 1.0
+    TOLERANCE = 1.5
+    HISTORY = 10
+
+    def __init__(self, name, maximum, unit="operations"):
+        self.name = name
+        self.maximum = max(maximum, 1)
+        self.unit = unit
+        self.limit = 1
+        self.active = 0
+        self.condition = threading.Condition()
+        self.latencies = deque(maxlen=self.HISTORY)
+        self.throughput = 0.0
+        self.operations = 0
+        self.limit_time = 0.0
+        self.total_time = 0.0
+        self.changed = False
+        self.counted = time.monotonic()
+        self._start_interval(self.counted)
+
+    def _start_interval(self, now):
+        self.interval_started = now
+        self.interval_amount = 0
+        self.interval_busy = 0.0
+        self.waited = False
+
+    @contextmanager
+    def operation(self, amount=1):
+        """Context manager for an operation of the stage, which waits until
+        fewer than limit operations are running. The amount is the size of
+        the operation (e.g. the number of bytes read)."""
+        with self.condition:
+            while self.active >= self.limit:
+                self.waited = True
+                self.condition.wait()
+            self._count_busy(time.monotonic())
+            self.active += 1
+        try:
+            yield
+        finally:
+            now = time.monotonic()
+            with self.condition:
+                self._count_busy(now)
+                self.active -= 1
+                self.operations += 1
+                self.interval_amount += amount
+                if now - self.interval_started >= self.INTERVAL:
+                    self._adjust(now)
+                self.condition.notify_all()
+
+    def _count_busy(self, now):
+        self.interval_busy += self.active * (now - self.counted)
+        self.counted = now
+
+    def _adjust(self, now):
+        elapsed = now - self.interval_started
+        self.throughput = self.interval_amount / elapsed
+        self.limit_time += self.limit * elapsed
+        self.total_time += elapsed
+
+        if self.interval_amount > 0:
+            latency = self.interval_busy / self.interval_amount
+            self.latencies.append(latency)
+            if latency > self.TOLERANCE * min(self.latencies) and self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                self.changed = True
+            elif self.waited and self.limit < self.maximum:
+                self.limit += 1
+                self.changed = True
+        self._start_interval(now)
+
+    def average_limit(self):
+        if self.total_time == 0:
+            return float(self.limit)
+        return self.limit_time / self.total_time
+
+    def __str__(self):
+        if self.unit == "bytes":
+            throughput = "{:.1f} MB/s".format(self.throughput / 1e6)
+        else:
+            throughput = "{:.1f} {}/s".format(self.throughput, self.unit)
+        return "{} {}/{} ({})".format(self.name, self.limit, self.maximum, throughput)
+
+
+class ConcurrencyController(object):
+    """Adaptive limits on the concurrency of catalog queries, metadata
+    operations (stat calls and S3 HEAD requests) and reads, which are shared
+    by all resource interfaces and worker threads of a check. A controller
+    without stages does not limit anything.
+
+    The limits are printed when they have changed, at most once every
+    PROGRESS_INTERVAL seconds.
+
+    :param catalog: maximum number of concurrent catalog queries
+    :param stat: maximum number of concurrent metadata operations
+    :param read: maximum number of files or objects read concurrently"""
+
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, catalog=None, stat=None, read=None, output=sys.stderr):
+        self.stages = OrderedDict()
+        for name, maximum, unit in (("catalog", catalog, "queries"),
+                                    ("stat", stat, "operations"),
+                                    ("read", read, "bytes")):
+            if maximum is not None:
+                self.stages[name] = AdaptiveLimit(name, maximum, unit)
+        self.output = output
+        self.lock = threading.Lock()
+        self.reported = time.monotonic()
+
+    @contextmanager
+    def _operation(self, limit, amount):
+        with limit.operation(amount):
+            yield
+        self._report_progress()
+
+    def operation(self, stage, amount=1):
+        """Context manager for an operation of a stage (catalog, stat or
+        read), see AdaptiveLimit.operation"""
+        limit = self.stages.get(stage)
+        if limit is None:
+            return nullcontext()
+        return self._operation(limit, amount)
+
+    def _report_progress(self):
+        now = time.monotonic()
+        with self.lock:
+            if (now - self.reported < self.PROGRESS_INTERVAL
+                    or not any(limit.changed for limit in self.stages.values())):
+                return
+            self.reported = now
+            for limit in self.stages.values():
+                limit.changed = False
+        print("Concurrency: " + ", ".join(str(limit) for limit in self.stages.values()),
+              file=self.output)
+
+    def add_statistics(self, statistics):
+        for name, limit in self.stages.items():
+            if limit.operations:
+                statistics.increment("Average concurrency of {} stage".format(name),
+                                     limit.average_limit())
+                statistics.increment("Final concurrency of {} stage".format(name),
+                                     limit.limit)
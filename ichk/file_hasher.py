@@ -0,0 +1,74 @@
+"""Hashing of files in unixfilesystem vaults"""
+
+import os
+import threading
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+_buffers = threading.local()
+
+
+def chunk_size_for(size):
+    """Returns the read size for a file of a particular size: the smallest
+    power of two that reads the file in at most 16 chunks, within the
+    minimum and maximum chunk size."""
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size < MAX_CHUNK_SIZE and chunk_size * 16 < size:
+        chunk_size *= 2
+    return chunk_size
+
+
+def _get_buffer(size):
+    """Returns a read buffer of the thread, which is reused for all files
+    that the thread hashes."""
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        _buffers.buffer = buffer
+    return buffer
+
+
+def _advise(fd, offset, length, advice):
+    """Calls posix_fadvise, on platforms that support it"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def hash_file(f, hsh, size=None, on_read=None):
+    """Feeds the contents of a file to a hashlib object, and returns the
+    number of bytes that were read.
+
+    The file is read into a reusable buffer, so no objects are allocated per
+    chunk. The kernel is advised that the file is read sequentially, and that
+    the pages that have been read are not needed anymore, so that hashing a
+    vault does not push frequently used data out of the page cache.
+
+    :param f: file object, opened in unbuffered binary mode
+    :param hsh: hashlib object
+    :param size: expected size of the file, used to choose the chunk size
+    :param on_read: optional function that is called with the length of each chunk read"""
+    fd = f.fileno()
+    if size is None:
+        size = os.fstat(fd).st_size
+
+    chunk_size = chunk_size_for(size)
+    total = 0
+
+    _advise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+    buffer = memoryview(_get_buffer(chunk_size))[:chunk_size]
+    while True:
+        length = f.readinto(buffer)
+        if not length:
+            break
+        hsh.update(buffer[:length])
+        if on_read is not None:
+            on_read(length)
+        _advise(fd, total, length, "POSIX_FADV_DONTNEED")
+        total += length
+
+    return total
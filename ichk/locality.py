@@ -0,0 +1,70 @@
+"""Ordering of reads by their location on disk"""
+
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# From linux/fs.h and linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+FIEMAP_EXTENT_UNKNOWN = 0x2
+
+# Location keys are (class, position) tuples. Only positions of the same
+# class can be compared: physical offsets (or inode numbers, if files are
+# ordered by inode) are LOCATED, and the inode numbers of files whose
+# physical offset is not known are UNLOCATED, so they are ordered after the
+# others.
+LOCATED = 0
+UNLOCATED = 1
+
+
+def physical_offset(path):
+    """Returns the physical offset on its device of the first extent of a
+    file, as reported by the FIEMAP ioctl, or None if it is not known (e.g.
+    because the platform or file system does not support FIEMAP, or the file
+    is empty)."""
+    if fcntl is None:
+        return None
+
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+    mapped_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if mapped_extents == 0:
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return extent[1]
+
+
+def seek_distance(keys, previous=None):
+    """Returns the sum of the distances between consecutive LOCATED location
+    keys, as a measure of the seeking needed to read files in that order,
+    along with the last of those keys. UNLOCATED keys are left out.
+
+    :param keys: location keys
+    :param previous: LOCATED key of the file that was read before the first one"""
+    distance = 0
+    for key in keys:
+        if key[0] != LOCATED:
+            continue
+        if previous is not None:
+            distance += abs(key[1] - previous[1])
+        previous = key
+    return distance, previous
@@ -0,0 +1,71 @@
+"""Merge the CSV output of the shards of a check into a single report."""
+
+import argparse
+import csv
+import sys
+from collections import Counter
+
+
+def entry():
+    """Used as entry_point in setup.py"""
+    try:
+        main(get_args())
+    except KeyboardInterrupt:
+        print("Script interrupted by user.", file=sys.stderr)
+
+
+def get_args():
+    '''Returns command line arguments of the script.'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("inputs", nargs="+", metavar="FILE",
+                        help="CSV output of a shard (ichk --shard K/N -m csv)")
+    parser.add_argument("-o", "--output",
+                        help="Write merged output to file")
+    return parser.parse_args()
+
+
+def main(args):
+    output = sys.stdout if args.output is None else open(args.output, "w")
+    writer = csv.writer(output, dialect=csv.excel)
+    header = None
+    counts = Counter()
+
+    for input_path in args.inputs:
+        try:
+            input_file = open(input_path, "r", newline="")
+        except OSError as e:
+            print("Error: cannot open {}: {}".format(input_path, e), file=sys.stderr)
+            sys.exit(1)
+
+        with input_file:
+            reader = csv.reader(input_file, dialect=csv.excel)
+            input_header = next(reader, None)
+            if input_header is None or "Type" not in input_header or "Status" not in input_header:
+                print("Error: {} is not CSV output of ichk.".format(input_path), file=sys.stderr)
+                sys.exit(1)
+
+            if header is None:
+                header = input_header
+                type_column = header.index("Type")
+                status_column = header.index("Status")
+                writer.writerow(header)
+            elif input_header != header:
+                print("Error: {} has different columns than {}.".format(input_path, args.inputs[0]),
+                      file=sys.stderr)
+                sys.exit(1)
+
+            for row in reader:
+                writer.writerow(row)
+                counts[(row[type_column], row[status_column])] += 1
+
+    if output is not sys.stdout:
+        output.close()
+
+    report_summary(counts, sys.stderr)
+
+
+def report_summary(counts, output):
+    print("Summary:", file=output)
+    for (obj_type, status), count in sorted(counts.items()):
+        print("  {} {}: {}".format(obj_type, status, count), file=output)
+    print("  Total: {}".format(sum(counts.values())), file=output)
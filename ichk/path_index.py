@@ -0,0 +1,68 @@
+"""Compact index of the physical paths of the replicas on a resource"""
+
+import hashlib
+import math
+import mmap
+import tempfile
+
+
+class PathIndex(object):
+    """Bloom filter of physical paths. A path that is not in the index has
+    certainly not been added, so the catalog only has to be queried for paths
+    that are (or seem to be) in the index.
+
+    The bit array is kept in memory if it is at most max_memory bytes, and
+    in a memory-mapped temporary file otherwise.
+
+    :param expected_entries: number of paths that will be added
+    :param false_positive_rate: probability that a path that has not been added
+                                is reported to be in the index, once all
+                                expected paths have been added
+    :param max_memory: maximum size in bytes of the bit array in memory, or None"""
+
+    def __init__(self, expected_entries, false_positive_rate=0.01, max_memory=None):
+        expected_entries = max(expected_entries, 1)
+        self.size = max(64, int(math.ceil(
+            -expected_entries * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / expected_entries * math.log(2))))
+        self.entries = 0
+        self.nbytes = (self.size + 7) // 8
+        self.spill_file = None
+
+        if max_memory is not None and self.nbytes > max_memory:
+            self.spill_file = tempfile.TemporaryFile(prefix="ichk-path-index-")
+            self.spill_file.truncate(self.nbytes)
+            self.bits = mmap.mmap(self.spill_file.fileno(), self.nbytes)
+        else:
+            self.bits = bytearray(self.nbytes)
+
+    def _positions(self, path):
+        digest = hashlib.blake2b(path.encode("utf-8", "surrogateescape"),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, path):
+        for position in self._positions(path):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.entries += 1
+
+    def __contains__(self, path):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(path))
+
+    @property
+    def spilled(self):
+        return self.spill_file is not None
+
+    def expected_false_positive_rate(self):
+        """Returns the probability of a false positive for the paths that
+        have been added"""
+        return (1 - math.exp(-self.hashes * self.entries / self.size)) ** self.hashes
+
+    def close(self):
+        if self.spill_file is not None:
+            self.bits.close()
+            self.spill_file.close()
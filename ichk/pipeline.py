@@ -0,0 +1,136 @@
+"""Run checks as a pipeline of stages, while keeping output in order"""
+
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class StagedPipeline(object):
+    """Runs checks in stages (e.g. metadata, then checksums), each with its
+    own worker threads and a bounded input queue, so that the latency of the
+    catalog, of metadata operations and of reading data overlap. The results
+    are passed to a consumer (typically a formatter) by an output thread, in
+    the order in which the checks were submitted.
+
+    Submitted arguments are passed to the function of the first stage, and
+    the return value of each stage is passed to the next one. The number of
+    checks in the pipeline is bounded, so a producer that is faster than the
+    pipeline waits.
+
+    :param consumer: function that is called with each result
+    :param stages: list of (name, function, workers) tuples
+    :param queue_size: maximum number of checks waiting for a stage, per
+                       worker of the stage"""
+
+    def __init__(self, consumer, stages, queue_size=4):
+        self.consumer = consumer
+        self.names = [name for name, function, workers in stages]
+        self.workers = [workers for name, function, workers in stages]
+        self.queues = [queue.Queue(queue_size * workers)
+                       for name, function, workers in stages]
+        self.output = queue.Queue(sum(q.maxsize for q in self.queues) + len(stages))
+        self.error = None
+        self.samples = 0
+        self.depth_totals = [0] * (len(stages) + 1)
+        self.threads = []
+
+        for index, (name, function, workers) in enumerate(stages):
+            for worker in range(workers):
+                self._start(self._run_stage, index, function)
+        self._start(self._run_output)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _run_stage(self, index, function):
+        input_queue = self.queues[index]
+        is_last = index == len(self.queues) - 1
+        while True:
+            item = input_queue.get()
+            if item is None:
+                return
+            future, args = item
+            try:
+                value = function(*args)
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+            if is_last:
+                future.set_result(value)
+            else:
+                self.queues[index + 1].put((future, (value,)))
+
+    def _run_output(self):
+        while True:
+            future = self.output.get()
+            if future is None:
+                self.output.task_done()
+                return
+            try:
+                result = future.result()
+                if self.error is None:
+                    self.consumer(result)
+            except BaseException as e:
+                if self.error is None:
+                    self.error = e
+            self.output.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _sample_depths(self):
+        self.samples += 1
+        for index, q in enumerate(self.queues + [self.output]):
+            self.depth_totals[index] += q.qsize()
+
+    def submit(self, *args):
+        """Schedule a check. The arguments are passed to the function of the
+        first stage. The result of the last stage is passed to the consumer
+        after the results of all previously submitted checks."""
+        self._raise_error()
+        self._sample_depths()
+        future = Future()
+        self.output.put(future)
+        self.queues[0].put((future, args))
+
+    def put(self, result):
+        """Pass a result that is already available to the consumer, after the
+        results of all previously submitted checks."""
+        self._raise_error()
+        future = Future()
+        future.set_result(result)
+        self.output.put(future)
+
+    def flush(self):
+        """Wait for all pending checks and pass their results to the consumer"""
+        self.output.join()
+        self._raise_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for q, workers in zip(self.queues, self.workers):
+                for worker in range(workers):
+                    q.put(None)
+            self.output.put(None)
+            for thread in self.threads:
+                thread.join()
+
+    def add_samples(self, other):
+        """Adds the queue depth samples of another pipeline with the same
+        stages to those of this pipeline"""
+        self.samples += other.samples
+        self.depth_totals = [total + other_total for total, other_total
+                             in zip(self.depth_totals, other.depth_totals)]
+
+    def queue_depths(self):
+        """Returns the name and the average number of waiting checks of each
+        stage (including the output stage), sampled at each submission"""
+        samples = max(self.samples, 1)
+        return [(name, total / samples)
+                for name, total in zip(self.names + ["output"], self.depth_totals)]
@@ -0,0 +1,151 @@
+"""Limits on the rate of I/O of a check"""
+
+import json
+import os
+import sys
+import time
+from threading import Lock
+
+
+class TokenBucket(object):
+    """Token bucket that allows a number of units per second, with bursts of
+    up to one second worth of units. Consumers that exceed the rate are
+    delayed. Large requests are allowed to overdraw the bucket, and later
+    requests wait until the deficit has been made up.
+
+    :param rate: units per second, or None for no limit"""
+
+    def __init__(self, rate=None):
+        self.lock = Lock()
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate if rate else None
+            if self.rate is not None:
+                self.tokens = min(self.tokens, self.rate)
+
+    def consume(self, amount):
+        """Takes units from the bucket, waiting if the rate is exceeded.
+        Returns the number of seconds waited."""
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class RateLimiter(object):
+    """Limits the rate at which resource interfaces read data (bytes per
+    second) and perform metadata operations, such as stat calls and S3 HEAD
+    requests (operations per second). The limiter is shared by all resource
+    interfaces and worker threads of a check.
+
+    The limits can be changed while a check is running with a control file.
+    This is a JSON object with max_read_rate and/or max_ops_rate keys; a null
+    value removes the limit. The file is read again when it is modified, or
+    when a reload is requested (e.g. from a SIGHUP handler).
+
+    :param max_read_rate: maximum number of bytes read per second, or None
+    :param max_ops_rate: maximum number of metadata operations per second, or None
+    :param control_file: optional path of a control file"""
+
+    CONTROL_FILE_CHECK_INTERVAL = 5
+
+    def __init__(self, max_read_rate=None, max_ops_rate=None, control_file=None):
+        self.reads = TokenBucket(max_read_rate)
+        self.operations = TokenBucket(max_ops_rate)
+        self.control_file = control_file
+        self.control_file_mtime = None
+        self.control_file_checked = time.monotonic()
+        self.reload_requested = False
+        self.lock = Lock()
+        self.delay = 0.0
+
+        if control_file is not None and os.path.exists(control_file):
+            self.load_control_file()
+
+    def read(self, nbytes):
+        """Accounts for a number of bytes read, waiting if the read rate is exceeded."""
+        self._check_control_file()
+        self._add_delay(self.reads.consume(nbytes))
+
+    def operation(self):
+        """Accounts for a metadata operation, waiting if the operation rate is exceeded."""
+        self._check_control_file()
+        self._add_delay(self.operations.consume(1))
+
+    def request_reload(self):
+        """Read the control file again before the next operation. Only sets a
+        flag, so it is safe to call from a signal handler."""
+        self.reload_requested = True
+
+    def _add_delay(self, delay):
+        if delay > 0:
+            with self.lock:
+                self.delay += delay
+
+    def _check_control_file(self):
+        if self.control_file is None:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            if (not self.reload_requested
+                    and now - self.control_file_checked < RateLimiter.CONTROL_FILE_CHECK_INTERVAL):
+                return
+            forced = self.reload_requested
+            self.reload_requested = False
+            self.control_file_checked = now
+
+        try:
+            mtime = os.stat(self.control_file).st_mtime_ns
+        except OSError:
+            return
+
+        if forced or mtime != self.control_file_mtime:
+            self.load_control_file()
+
+    def load_control_file(self):
+        """Applies the limits in the control file. Invalid control files are
+        reported and otherwise ignored, so that a typo does not end a check."""
+        try:
+            self.control_file_mtime = os.stat(self.control_file).st_mtime_ns
+            with open(self.control_file, "r") as f:
+                limits = json.load(f)
+            if not isinstance(limits, dict):
+                raise ValueError("expected a JSON object")
+            for key in ("max_read_rate", "max_ops_rate"):
+                value = limits.get(key)
+                if value is not None and (isinstance(value, bool)
+                                          or not isinstance(value, (int, float))
+                                          or value <= 0):
+                    raise ValueError("{} should be a positive number or null".format(key))
+        except (OSError, ValueError) as e:
+            print("Warning: ignoring rate control file {}: {}".format(self.control_file, e),
+                  file=sys.stderr)
+            return
+
+        if "max_read_rate" in limits:
+            self.reads.set_rate(limits["max_read_rate"])
+        if "max_ops_rate" in limits:
+            self.operations.set_rate(limits["max_ops_rate"])
+
+        print("Rate limits: {} bytes/s, {} operations/s".format(
+            self.reads.rate or "unlimited", self.operations.rate or "unlimited"),
+            file=sys.stderr)
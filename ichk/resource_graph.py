@@ -0,0 +1,71 @@
+"""In-memory graph of the resources in the zone"""
+
+from collections import defaultdict
+
+from irods.models import Resource
+
+
+class ResourceGraph(object):
+    """Index of all resources in the zone, loaded with a single catalog query.
+    Resources are stored as query result rows, so their attributes can be
+    accessed in the same way as in other query results (e.g.
+    resource[Resource.name]). They are sorted by name, so that the order
+    does not depend on the order of the rows."""
+
+    def __init__(self, session):
+        self.resources = sorted(session.query(Resource).get_results(),
+                                key=lambda r: r[Resource.name])
+        self.by_id = {}
+        self.by_name = {}
+        self.by_location = defaultdict(list)
+        self.by_vault_path = {}
+        self.children_by_parent = defaultdict(list)
+
+        for resource in self.resources:
+            self.by_id[str(resource[Resource.id])] = resource
+            self.by_name[resource[Resource.name]] = resource
+            self.by_location[resource[Resource.location]].append(resource)
+            self.by_vault_path[(resource[Resource.vault_path],
+                                resource[Resource.location])] = resource
+
+        for resource in self.resources:
+            parent = self.parent(resource)
+            if parent is not None:
+                self.children_by_parent[parent[Resource.name]].append(resource)
+
+    def get(self, resource_name):
+        """Returns the resource with a particular name, or None if it does not exist."""
+        return self.by_name.get(resource_name)
+
+    def get_by_vault_path(self, vault_path, location):
+        """Returns the resource with a vault path on a server, or None if it does not exist."""
+        return self.by_vault_path.get((vault_path, location))
+
+    def at_location(self, location, resource_types):
+        """Returns the resources on a server that have one of the given types, sorted by name."""
+        return [resource for resource in self.by_location.get(location, [])
+                if resource[Resource.type] in resource_types]
+
+    def parent(self, resource):
+        """Returns the parent of a resource, or None for a root resource.
+        The parent is referred to by id (iRODS 4.2+) or by name (older versions)."""
+        parent = resource[Resource.parent]
+        if not parent:
+            return None
+        return self.by_id.get(parent, self.by_name.get(parent))
+
+    def children(self, resource):
+        """Returns the children of a resource, sorted by name. Children listed in
+        the children attribute (iRODS versions before 4.2) come first."""
+        result = []
+        children = resource[Resource.children]
+        if children:
+            for child_name in (c.strip("{}") for c in children.split(";")):
+                child = self.get(child_name.split("{")[0])
+                if child is not None:
+                    result.append(child)
+        names = {child[Resource.name] for child in result}
+        for child in self.children_by_parent.get(resource[Resource.name], []):
+            if child[Resource.name] not in names:
+                result.append(child)
+        return result
@@ -2,11 +2,25 @@ class ResourceInterface:
     def check_object_exists(self, path):
         raise Exception("Not implemented")
 
+    def stat_object(self, path, metadata=None):
+        """Returns the status of an object and its metadata. The metadata can
+        be passed to get_size and get_checksum, so that they don't have to
+        retrieve it again. Metadata that is already known (e.g. from a
+        directory listing) can be passed as a hint."""
+        return self.check_object_exists(path), None
+
+    def locality_key(self, path, metadata=None, method="inode"):
+        """Returns a key by which checks of objects can be ordered, so that
+        they are read with fewer seeks, along with the metadata of the
+        object (see stat_object). The key is None if the storage does not
+        benefit from ordering."""
+        return None, metadata
+
     def check_coll_exists(self, path):
         raise Exception("Not implemented")
 
-    def get_size(self, path):
+    def get_size(self, path, metadata=None):
         raise Exception("Not implemented")
 
-    def get_checksum(self, path, checksumtype):
+    def get_checksum(self, path, checksumtype, metadata=None):
         raise Exception("Not implemented")
@@ -1,4 +1,3 @@
-import irods.exception as iexc
 from irods.models import Resource
 
 from ichk.s3_resource_interface import S3ResourceInterface
@@ -6,32 +5,37 @@ from ichk.ufs_resource_interface import UFSResourceInterface
 
 
 class ResourceInterfaceFactory:
-    def __init__(self, session):
+    def __init__(self, session, resource_graph, checksum_cache=None,
+                 statistics=None, rate_limiter=None, s3_options=None,
+                 concurrency=None):
         self.resource_interface_cache = dict()
         self.session = session
+        self.resource_graph = resource_graph
+        self.checksum_cache = checksum_cache
+        self.statistics = statistics
+        self.rate_limiter = rate_limiter
+        self.s3_options = s3_options or {}
+        self.concurrency = concurrency
 
     def get_resource_interface(self, resource_name):
         if resource_name in self.resource_interface_cache:
             return self.resource_interface_cache.get(resource_name)
 
-        resource_type = self._get_resource_type(resource_name)
+        resource = self.resource_graph.get(resource_name)
+        resource_type = None if resource is None else resource[Resource.type]
         if resource_type == "unixfilesystem":
-            result = UFSResourceInterface()
+            result = UFSResourceInterface(
+                self.checksum_cache, self.statistics, self.rate_limiter,
+                self.concurrency)
             self.resource_interface_cache[resource_name] = result
             return result
         elif resource_type == "s3":
-            result = S3ResourceInterface(self.session, resource_name)
+            result = S3ResourceInterface(
+                resource, self.rate_limiter, self.statistics,
+                concurrency=self.concurrency, **self.s3_options)
             self.resource_interface_cache[resource_name] = result
             return result
         elif resource_type is None:
             return None
         else:
             raise ValueError(f"Resource type {resource_type} not supported.")
-
-    def _get_resource_type(self, resource_name):
-        try:
-            resource = self.session.query(Resource).filter(
-                Resource.name == resource_name).one()
-        except iexc.NoResultFound:
-            return None
-        return resource[Resource.type]
@@ -1,47 +1,116 @@
 import base64
 import hashlib
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import botocore.config
 import botocore.exceptions
-import irods.exception as iexc
 from irods.models import Resource
 
+from ichk.concurrency import ConcurrencyController
+from ichk.rate_limiter import RateLimiter
 from ichk.resource_interface import ResourceInterface
 from ichk.status_codes import Status
 
 
 class S3ResourceInterface(ResourceInterface):
-    CHUNK_SIZE = 8192
-
-    def __init__(self, irods_session, resource_name):
-        self.irods_session = irods_session
-        self.resource_name = resource_name
-        self.s3_hostname = self._get_s3_hostname(resource_name)
-        (self.s3_accesskey, self.s3_secretkey) = self._get_s3_credentials(resource_name)
-        self.s3_region = self._get_resource_context_param(
-            resource_name, "S3_REGIONNAME")
-        self.s3_protocol = self._get_s3_proto(resource_name)
+    CHUNK_SIZE = 1024 * 1024
+    # Objects larger than this are downloaded as concurrent byte ranges
+    RANGE_SIZE = 8 * 1024 * 1024
+    # The ETag of an object that was uploaded in a single part without
+    # SSE-KMS or SSE-C encryption is the MD5 checksum of its contents.
+    # Multipart ETags have a "-<number of parts>" suffix.
+    MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+    def __init__(self, resource, rate_limiter=None, statistics=None,
+                 force_download_verify=False, max_connections=10,
+                 download_threads=1, concurrency=None):
+        """:param force_download_verify: always download objects to verify
+                                         their MD5 checksum
+        :param max_connections: size of the connection pool of the S3 client
+        :param download_threads: number of byte ranges of an object that are
+                                 downloaded concurrently"""
+        self.resource_name = resource[Resource.name]
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.concurrency = concurrency if concurrency is not None else ConcurrencyController()
+        self.statistics = statistics
+        self.force_download_verify = force_download_verify
+        self.download_threads = download_threads
+        self.resource_context = self._parse_resource_context(
+            resource[Resource.context])
+        self.s3_hostname = self._get_s3_hostname()
+        (self.s3_accesskey, self.s3_secretkey) = self._get_s3_credentials()
+        self.s3_region = self._get_resource_context_param("S3_REGIONNAME")
+        self.s3_protocol = self._get_s3_proto()
         boto3_session = boto3.Session(aws_access_key_id=self.s3_accesskey.strip(),
                                       aws_secret_access_key=self.s3_secretkey.strip(),
                                       region_name=self.s3_region.strip())
         self.endpoint_url = self.s3_protocol + "://" + self.s3_hostname
         self.boto3_client = boto3_session.client(
-            's3', endpoint_url=self.endpoint_url)
+            's3', endpoint_url=self.endpoint_url,
+            config=botocore.config.Config(max_pool_connections=max_connections))
 
     def check_object_exists(self, path):
+        return self.stat_object(path)[0]
+
+    def stat_object(self, path, metadata=None):
+        """Returns the status and the metadata of an object. The metadata is
+        the response of a HEAD request, which is reused for checking the size
+        and checksum of the object. Metadata that is passed in is returned
+        as is."""
+        if metadata is not None:
+            return Status.OK, metadata
+
         bucket = self._get_bucket_name(path)
         key = self._get_key_name(path)
+        self.rate_limiter.operation()
         try:
-            self.boto3_client.head_object(Bucket=bucket, Key=key)
+            with self.concurrency.operation("stat"):
+                metadata = self.boto3_client.head_object(Bucket=bucket, Key=key)
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
-                return Status.NOT_EXISTING
+                return Status.NOT_EXISTING, None
             elif e.response['Error']['Code'] == "403":
-                return Status.ACCESS_DENIED
+                return Status.ACCESS_DENIED, None
             else:
-                raise ()
+                raise
+
+        return Status.OK, metadata
 
-        return Status.OK
+    def list_objects(self, path, start_after=None):
+        """Lists the objects under a physical path with paginated
+        list_objects_v2 requests, in order of key. Yields the physical path
+        and the metadata of each object, which can be passed to get_size and
+        get_checksum instead of the response of a HEAD request.
+
+        :param path: physical path of the vault, or of a directory in it
+        :param start_after: optional physical path; only objects after it are listed"""
+        bucket = self._get_bucket_name(path)
+        vault_dir = path.split("/")[2]
+        prefix = self._get_key_name(path.rstrip("/"))
+        if not prefix.endswith("/"):
+            prefix += "/"
+
+        request = {"Bucket": bucket, "Prefix": prefix}
+        if start_after is not None:
+            request["StartAfter"] = self._get_key_name(start_after)
+
+        for page in self.boto3_client.get_paginator("list_objects_v2").paginate(**request):
+            self.rate_limiter.operation()
+            if self.statistics is not None:
+                self.statistics.increment("S3 list requests")
+            for entry in page.get("Contents", []):
+                key = entry["Key"]
+                phy_path = "/".join(["", bucket, vault_dir, key.split("/", 1)[1]])
+                # Listings do not show whether objects are encrypted, which
+                # determines whether their ETag is an MD5 checksum.
+                metadata = {"ContentLength": entry["Size"],
+                            "ETag": entry["ETag"],
+                            "LastModified": entry["LastModified"],
+                            "Listed": True}
+                yield phy_path, metadata
 
     def _get_bucket_name(self, path):
         return path.split("/")[1]
@@ -53,13 +122,23 @@ class S3ResourceInterface(ResourceInterface):
         # Collections do not exist separately from objects on S3 resources
         return Status.UNKNOWN
 
-    def get_size(self, path):
-        bucket = self._get_bucket_name(path)
-        key = self._get_key_name(path)
-        object = self.boto3_client.head_object(Bucket=bucket, Key=key)
-        return object["ContentLength"]
+    def get_size(self, path, metadata=None):
+        if metadata is None:
+            status, metadata = self.stat_object(path)
+            if metadata is None:
+                raise ValueError(f"Cannot retrieve size of {path}: {status.name}")
+        return metadata["ContentLength"]
+
+    def _get_etag_md5(self, metadata):
+        """Returns the MD5 checksum of an object from its ETag, or None if the
+        ETag is not an MD5 checksum."""
+        if (metadata.get("ServerSideEncryption") == "aws:kms"
+                or metadata.get("SSECustomerAlgorithm") is not None):
+            return None
+        match = S3ResourceInterface.MD5_ETAG.match(metadata.get("ETag", ""))
+        return match.group(1) if match else None
 
-    def get_checksum(self, path, checksumtype):
+    def get_checksum(self, path, checksumtype, metadata=None):
         if checksumtype == "md5":
             hsh = hashlib.md5()
         elif checksumtype == "sha2":
@@ -67,55 +146,109 @@ class S3ResourceInterface(ResourceInterface):
         else:
             raise ValueError(f"Checksum type {checksumtype} not supported.")
 
+        if metadata is None:
+            status, metadata = self.stat_object(path)
+            if metadata is None:
+                raise ValueError(f"Cannot retrieve checksum of {path}: {status.name}")
+
+        if checksumtype == "md5" and not self.force_download_verify:
+            if metadata.get("Listed") and self._get_etag_md5(metadata) is not None:
+                status, metadata = self.stat_object(path)
+                if metadata is None:
+                    raise ValueError(f"Cannot retrieve checksum of {path}: {status.name}")
+            checksum = self._get_etag_md5(metadata)
+            if checksum is not None:
+                if self.statistics is not None:
+                    self.statistics.increment("S3 checksums taken from ETag")
+                return checksum
+
         bucket = self._get_bucket_name(path)
         key = self._get_key_name(path)
+        size = metadata["ContentLength"]
 
+        with self.concurrency.operation("read", size):
+            if size > S3ResourceInterface.RANGE_SIZE and self.download_threads > 1:
+                self._hash_ranges(bucket, key, hsh, size, metadata.get("ETag"))
+            else:
+                self._hash_stream(bucket, key, hsh)
+
+        if hsh.name == 'md5':
+            return hsh.hexdigest()
+        else:
+            return base64.b64encode(hsh.digest()).decode('ascii')
+
+    def _hash_stream(self, bucket, key, hsh):
+        self.rate_limiter.operation()
         with self.boto3_client.get_object(Bucket=bucket, Key=key)["Body"] as stream:
             while True:
                 chunk = stream.read(S3ResourceInterface.CHUNK_SIZE)
                 if chunk:
+                    self.rate_limiter.read(len(chunk))
                     hsh.update(chunk)
                 else:
                     break
 
-        if hsh.name == 'md5':
-            return hsh.hexdigest()
-        else:
-            return base64.b64encode(hsh.digest()).decode('ascii')
+    def _hash_ranges(self, bucket, key, hsh, size, etag):
+        """Downloads byte ranges of an object concurrently, and hashes them
+        in order. At most download_threads ranges are held in memory. If the
+        ETag is known, the download fails if the object has been replaced
+        since it was retrieved."""
+        ranges = iter(range(0, size, S3ResourceInterface.RANGE_SIZE))
+        pending = deque()
+
+        with ThreadPoolExecutor(self.download_threads) as executor:
+            for start in ranges:
+                pending.append(executor.submit(
+                    self._get_range, bucket, key, start, size, etag))
+                if len(pending) >= self.download_threads:
+                    break
 
-    def _get_s3_proto(self, resource_name):
-        value = self._get_resource_context_param(resource_name, "S3_PROTO")
+            while pending:
+                data = pending.popleft().result()
+                start = next(ranges, None)
+                if start is not None:
+                    pending.append(executor.submit(
+                        self._get_range, bucket, key, start, size, etag))
+                hsh.update(data)
+
+    def _get_range(self, bucket, key, start, size, etag):
+        end = min(start + S3ResourceInterface.RANGE_SIZE, size) - 1
+        request = {"Bucket": bucket, "Key": key,
+                   "Range": f"bytes={start}-{end}"}
+        if etag:
+            request["IfMatch"] = etag
+        self.rate_limiter.operation()
+        with self.boto3_client.get_object(**request)["Body"] as stream:
+            data = stream.read()
+        self.rate_limiter.read(len(data))
+        return data
+
+    def _get_s3_proto(self):
+        value = self._get_resource_context_param("S3_PROTO")
         return value.lower() if value is not None else "https"
 
-    def _get_s3_hostname(self, resource_name):
-        return self._get_resource_context_param(resource_name,
-                                                "S3_DEFAULT_HOSTNAME")
+    def _get_s3_hostname(self):
+        return self._get_resource_context_param("S3_DEFAULT_HOSTNAME")
 
-    def _get_s3_credentials(self, resource_name):
-        authfile = self._get_resource_context_param(resource_name,
-                                                    "S3_AUTH_FILE")
+    def _get_s3_credentials(self):
+        authfile = self._get_resource_context_param("S3_AUTH_FILE")
 
         if authfile is None:
             raise Exception(
-                f"Could not find auth file config for S3 resource {resource_name}")
+                f"Could not find auth file config for S3 resource {self.resource_name}")
 
         with open(authfile, "r") as f:
             accesskey = f.readline()
             secretkey = f.readline()
             return (accesskey, secretkey)
 
-    def _get_resource_context_param(self, resource_name, param):
-        context = self._get_resource_context(resource_name)
-        for kvpair in context.split(";"):
-            (k, v) = kvpair.split("=")
-            if param == k:
-                return v
-        return None
+    def _get_resource_context_param(self, param):
+        return self.resource_context.get(param)
 
-    def _get_resource_context(self, resource_name):
-        try:
-            resource = self.irods_session.query(Resource).filter(
-                Resource.name == resource_name).one()
-        except iexc.NoResultFound:
-            return None
-        return resource[Resource.context]
+    def _parse_resource_context(self, context):
+        result = {}
+        for kvpair in (context or "").split(";"):
+            if "=" in kvpair:
+                (k, v) = kvpair.split("=", 1)
+                result[k] = v
+        return result
@@ -0,0 +1,84 @@
+"""State file for resuming interrupted scans"""
+
+import json
+import os
+import time
+
+
+class ScanState(object):
+    """Progress of a scan, stored in a JSON file, so that an interrupted scan
+    can be resumed.
+
+    :param path: path of the state file
+    :param scan: dictionary that identifies the scan (mode, target, options).
+                 A scan can only be resumed with the same parameters.
+    :param interval: minimum number of seconds between saves of the state"""
+
+    VERSION = 1
+
+    # Parameters that determine which objects a scan checks
+    TARGET_KEYS = ("fqdn", "resource", "vault", "data_object_list", "all_local_resources",
+                   "all_local_vaults", "root_collection", "shard")
+
+    def __init__(self, path, scan, interval=60):
+        self.path = path
+        self.scan = scan
+        self.interval = interval
+        self.last_saved = time.monotonic()
+        self.last_completed_started = None
+
+    def load(self):
+        """Returns the state saved by a previous run, or None if there is none."""
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            raise ValueError("Cannot read state file {}: {}".format(self.path, e))
+
+        if data.get("version") != ScanState.VERSION:
+            raise ValueError("State file {} has an unsupported version.".format(self.path))
+
+        return data
+
+    def resumable_progress(self, data):
+        """Returns the progress of an interrupted scan in state data, or None if
+        the scan was completed. Raises a ValueError if the state data is of a
+        different scan."""
+        if data is None or data.get("completed"):
+            return None
+        if data.get("scan") != self.scan:
+            raise ValueError("State file {} belongs to a scan with different parameters."
+                             .format(self.path))
+        return data["progress"]
+
+    def last_completed_start(self, data):
+        """Returns the start time of the last completed run in state data, or
+        None if there is none. The state of an interrupted run keeps the start
+        time of the last completed run before it. Raises a ValueError if the
+        state data is of a scan of different objects."""
+        if data is None:
+            return None
+        if any(data.get("scan", {}).get(key) != self.scan.get(key)
+               for key in ScanState.TARGET_KEYS):
+            raise ValueError("State file {} belongs to a scan of different objects."
+                             .format(self.path))
+        if data.get("completed"):
+            return data["started"]
+        return data.get("last_completed_started")
+
+    def save_due(self):
+        return time.monotonic() - self.last_saved >= self.interval
+
+    def save(self, data):
+        """Atomically replaces the state file"""
+        data = dict(data, version=ScanState.VERSION, scan=self.scan,
+                    last_completed_started=self.last_completed_started)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.last_saved = time.monotonic()
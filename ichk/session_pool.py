@@ -0,0 +1,103 @@
+"""Pool of iRODS sessions for concurrent catalog queries"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import irods.exception as iexc
+from irods.models import Zone
+
+
+class SessionPool(object):
+    """Pool of iRODS sessions, so that several streams of catalog queries
+    (e.g. the checks of different leaf resources) can run at the same time.
+
+    A query that returns more than one page of results has to be continued
+    on the server connection on which it was started. Threads that share a
+    session can get each other's connections, so each stream of queries
+    gets a session of its own from the pool.
+
+    Sessions are cloned from a primary session when they are first needed,
+    and reused afterwards. Before a session is reused, it is checked with a
+    query for the zone, with a timeout of HEALTH_CHECK_TIMEOUT seconds. The
+    connections of a session that fails the check, that has been idle for
+    longer than max_idle_time, or that had a network error, are closed, so
+    that the session reconnects on its next request rather than using a
+    connection that the server has dropped.
+
+    :param session: primary session, from which sessions are cloned
+    :param size: maximum number of sessions in use at the same time
+    :param max_idle_time: seconds after which idle connections are not reused,
+                          by default the connection timeout of the session"""
+
+    HEALTH_CHECK_TIMEOUT = 5
+
+    def __init__(self, session, size=1, max_idle_time=None):
+        if size < 1:
+            raise ValueError("Size of session pool must be at least 1")
+        self.primary = session
+        self.size = size
+        if max_idle_time is None:
+            max_idle_time = session.connection_timeout
+        self.max_idle_time = max_idle_time
+        self.lock = threading.Condition()
+        self.idle = []
+        self.created = 0
+        self.reconnects = 0
+
+    def acquire(self):
+        """Returns a session from the pool, waiting if all sessions are in use"""
+        with self.lock:
+            while not self.idle and self.created >= self.size:
+                self.lock.wait()
+            if self.idle:
+                session, released = self.idle.pop()
+            else:
+                session, released = None, None
+                self.created += 1
+
+        if session is None:
+            session = self.primary.clone()
+        elif time.monotonic() - released > self.max_idle_time or not self._healthy(session):
+            self._reconnect(session)
+        return session
+
+    def _healthy(self, session):
+        """Returns whether a session can still send a query to the server"""
+        timeout = session.connection_timeout
+        session.connection_timeout = SessionPool.HEALTH_CHECK_TIMEOUT
+        try:
+            session.query(Zone.id).first()
+        except (iexc.NetworkException, OSError):
+            return False
+        finally:
+            session.connection_timeout = timeout
+        return True
+
+    def release(self, session):
+        with self.lock:
+            self.idle.append((session, time.monotonic()))
+            self.lock.notify()
+
+    @contextmanager
+    def session(self):
+        """Context manager that acquires a session and releases it afterwards"""
+        session = self.acquire()
+        try:
+            yield session
+        except iexc.NetworkException:
+            self._reconnect(session)
+            raise
+        finally:
+            self.release(session)
+
+    def _reconnect(self, session):
+        session.cleanup()
+        with self.lock:
+            self.reconnects += 1
+
+    def close(self):
+        with self.lock:
+            sessions, self.idle = self.idle, []
+        for session, released in sessions:
+            session.cleanup()
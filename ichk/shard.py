@@ -0,0 +1,38 @@
+"""Partitioning of checks into shards"""
+
+import zlib
+
+
+class Shard(object):
+    """One of a number of deterministic partitions of the work of a check,
+    so that a check can be split over several processes or servers. Work is
+    assigned to a shard by the CRC-32 checksum of a key (e.g. a collection
+    name), or by a number (e.g. a line number).
+
+    :param index: number of the shard, from 1 to count
+    :param count: number of shards"""
+
+    def __init__(self, index, count):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError("shard {}/{} does not exist".format(index, count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, spec):
+        """Returns the shard for a K/N specification"""
+        try:
+            index, count = (int(part) for part in spec.split("/"))
+        except ValueError:
+            raise ValueError("expected a shard as K/N, e.g. 1/4")
+        return cls(index, count)
+
+    def __contains__(self, key):
+        if isinstance(key, int):
+            value = key
+        else:
+            value = zlib.crc32(key.encode("utf-8", "surrogateescape"))
+        return value % self.count == self.index - 1
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.count)
@@ -0,0 +1,40 @@
+"""Counters that are reported at the end of a run"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class RunStatistics(object):
+    """Thread-safe named counters. Counters are reported in the order in
+    which they were first incremented."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = OrderedDict()
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def as_dict(self):
+        with self.lock:
+            return OrderedDict(self.counters)
+
+    def restore(self, counters):
+        """Continue counting from the counters of an earlier (interrupted) run"""
+        with self.lock:
+            self.counters = OrderedDict(counters)
+
+    def report(self, output):
+        with self.lock:
+            items = list(self.counters.items())
+        if items:
+            print("Statistics:", file=output)
+        for name, value in items:
+            if isinstance(value, float):
+                value = "{:.1f}".format(value)
+            print("  {}: {}".format(name, value), file=output)
@@ -2,37 +2,101 @@ import base64
 import errno
 import hashlib
 import os
+import time
 
+from ichk.concurrency import ConcurrencyController
+from ichk.file_hasher import hash_file
+from ichk.locality import LOCATED, physical_offset, UNLOCATED
+from ichk.rate_limiter import RateLimiter
 from ichk.resource_interface import ResourceInterface
 from ichk.status_codes import Status
 
 
 class UFSResourceInterface(ResourceInterface):
-    CHUNK_SIZE = 8192
+    def __init__(self, checksum_cache=None, statistics=None, rate_limiter=None,
+                 concurrency=None):
+        self.checksum_cache = checksum_cache
+        self.statistics = statistics
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.concurrency = concurrency if concurrency is not None else ConcurrencyController()
 
     def check_object_exists(self, path):
         return self._check_exists(path)
 
+    def stat_object(self, path, metadata=None):
+        """Returns the status and the stat result of a file. The metadata hint
+        can be an os.DirEntry of the file (e.g. from a vault walk), whose cached
+        stat result is then used."""
+        try:
+            stat_result = self._stat(path, metadata)
+        except OSError as e:
+            return self._error_status(e), None
+
+        return Status.OK, stat_result
+
     def check_coll_exists(self, path):
         return self._check_exists(path)
 
+    def locality_key(self, path, metadata=None, method="inode"):
+        """Returns the location key of a file (see locality.py): its inode
+        number, or the physical offset of its first extent if method is
+        "extent". Files without a known extent (e.g. empty files, or on file
+        systems without FIEMAP) get an UNLOCATED key with their inode number.
+        The stat result of the file is returned as metadata, so the check
+        does not have to stat the file again."""
+        if method == "inode" and isinstance(metadata, os.DirEntry):
+            return (LOCATED, metadata.inode()), metadata
+
+        try:
+            stat_result = self._stat(path, metadata)
+        except OSError:
+            return None, metadata
+
+        if method != "extent":
+            return (LOCATED, stat_result.st_ino), stat_result
+
+        offset = None
+        if stat_result.st_size > 0:
+            self.rate_limiter.operation()
+            offset = physical_offset(path)
+        if offset is None:
+            return (UNLOCATED, stat_result.st_ino), stat_result
+        return (LOCATED, offset), stat_result
+
     def _check_exists(self, path):
+        self.rate_limiter.operation()
         try:
-            os.stat(path)
+            with self.concurrency.operation("stat"):
+                os.stat(path)
         except OSError as e:
-            if e.errno == errno.ENOENT:
-                return Status.NOT_EXISTING
-            elif e.errno == errno.EACCES:
-                return Status.ACCESS_DENIED
-            else:
-                raise
+            return self._error_status(e)
 
         return Status.OK
 
-    def get_size(self, path):
-        return os.stat(path).st_size
+    def _error_status(self, e):
+        if e.errno == errno.ENOENT:
+            return Status.NOT_EXISTING
+        elif e.errno == errno.EACCES:
+            return Status.ACCESS_DENIED
+        else:
+            raise e
+
+    def _stat(self, path, metadata):
+        if metadata is None:
+            self.rate_limiter.operation()
+            with self.concurrency.operation("stat"):
+                return os.stat(path)
+        elif isinstance(metadata, os.DirEntry):
+            self.rate_limiter.operation()
+            with self.concurrency.operation("stat"):
+                return metadata.stat()
+        else:
+            return metadata
 
-    def get_checksum(self, path, checksumtype):
+    def get_size(self, path, metadata=None):
+        return self._stat(path, metadata).st_size
+
+    def get_checksum(self, path, checksumtype, metadata=None):
         if checksumtype == "md5":
             hsh = hashlib.md5()
         elif checksumtype == "sha2":
@@ -40,16 +104,35 @@ class UFSResourceInterface(ResourceInterface):
         else:
             raise ValueError(f"Checksum type {checksumtype} not supported.")
 
-        f = open(path, 'rb')
-
-        while True:
-            chunk = f.read(UFSResourceInterface.CHUNK_SIZE)
-            if chunk:
-                hsh.update(chunk)
+        with open(path, 'rb', buffering=0) as f:
+            if metadata is None:
+                self.rate_limiter.operation()
+                with self.concurrency.operation("stat"):
+                    stat_result = os.fstat(f.fileno())
             else:
-                break
+                stat_result = self._stat(path, metadata)
+
+            if self.checksum_cache is not None:
+                checksum = self.checksum_cache.get(stat_result, checksumtype)
+                if checksum is not None:
+                    return checksum
+
+            with self.concurrency.operation("read", stat_result.st_size):
+                started = time.monotonic()
+                length = hash_file(f, hsh, stat_result.st_size,
+                                   self.rate_limiter.read)
+                elapsed = time.monotonic() - started
+
+        if self.statistics is not None:
+            self.statistics.increment("Bytes hashed", length)
+            self.statistics.increment("Hashing time (s)", elapsed)
 
         if hsh.name == 'md5':
-            return hsh.hexdigest()
+            checksum = hsh.hexdigest()
         else:
-            return base64.b64encode(hsh.digest()).decode('ascii')
+            checksum = base64.b64encode(hsh.digest()).decode('ascii')
+
+        if self.checksum_cache is not None:
+            self.checksum_cache.put(stat_result, checksumtype, checksum)
+
+        return checksum
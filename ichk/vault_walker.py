@@ -0,0 +1,293 @@
+"""Walk vault directory trees"""
+
+import heapq
+import os
+import threading
+from concurrent.futures import Future
+
+
+class DirectoryScanner(object):
+    """Reads directories on worker threads ahead of a walk, so that the
+    latency of reading directories and getting file attributes (e.g. on NFS
+    or GPFS) overlaps, rather than adding up one request at a time.
+
+    When a directory has been read, its subdirectories that should be walked
+    are queued. Workers take queued directories in order of priority, i.e.
+    the order in which the walk needs them. At most lookahead directories
+    are read ahead of the walk. A directory that the walk needs before any
+    worker has started on it is read by the walk itself, so the walk never
+    waits for workers that are busy with directories that it needs later.
+
+    :param threads: number of worker threads
+    :param descend: optional function that is called with the path of each
+                    subdirectory, and returns whether to walk it. It is
+                    called on the worker threads.
+    :param priority: function that returns the sort key of a directory in
+                     the walk order
+    :param lookahead: maximum number of directories read ahead"""
+
+    def __init__(self, threads, descend=None, priority=None, lookahead=None):
+        self.descend = descend
+        self.priority = priority or (lambda path: path)
+        self.lock = threading.Lock()
+        self.work = threading.Condition(self.lock)
+        self.queue = []
+        self.scans = {}
+        self.slots = threading.Semaphore(lookahead or 16 * threads)
+        self.stopped = False
+        self.threads = [threading.Thread(target=self._run, daemon=True)
+                        for thread in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _schedule(self, path):
+        with self.lock:
+            self.scans[path] = [Future(), False]
+            heapq.heappush(self.queue, (self.priority(path), path))
+            self.work.notify()
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            with self.lock:
+                scan = None
+                while scan is None and not self.stopped:
+                    if not self.queue:
+                        self.work.wait()
+                        continue
+                    priority, path = heapq.heappop(self.queue)
+                    scan = self.scans.get(path)
+                    if scan is not None and scan[1]:
+                        # Already read by the walk
+                        scan = None
+                if self.stopped:
+                    return
+                scan[1] = True
+            self._scan(path, scan[0], prefetch_stat=True)
+
+    def _scan(self, path, future, prefetch_stat):
+        try:
+            entries = []
+            try:
+                with os.scandir(path) as scan:
+                    for entry in scan:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if prefetch_stat and not is_dir:
+                            try:
+                                # Cached by the DirEntry, for the check
+                                entry.stat()
+                            except OSError:
+                                pass
+                        entries.append((entry, is_dir))
+            except OSError:
+                future.set_result((None, set()))
+                return
+
+            subdirs = set()
+            for entry, is_dir in entries:
+                if (is_dir and not entry.is_symlink()
+                        and (self.descend is None or self.descend(entry.path))):
+                    subdirs.add(entry.path)
+                    self._schedule(entry.path)
+            future.set_result((entries, subdirs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def read(self, path):
+        """Returns the entries of a directory, as (entry, is_dir) tuples in
+        the order of os.scandir, and the set of paths of the subdirectories
+        that should be walked. The entries are None if the directory can't
+        be read."""
+        with self.lock:
+            scan = self.scans.pop(path, None)
+            if scan is None:
+                scan = [Future(), False]
+            read_ahead = scan[1]
+            scan[1] = True
+
+        if not read_ahead:
+            self._scan(path, scan[0], prefetch_stat=False)
+        else:
+            self.slots.release()
+        return scan[0].result()
+
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            self.work.notify_all()
+        for thread in self.threads:
+            self.slots.release()
+        for thread in self.threads:
+            thread.join()
+
+
+def walk_vault(top, descend=None, threads=1):
+    """Walks a directory tree with os.scandir, without building lists of the
+    files in each directory.
+
+    Directories are visited in pre-order, with subdirectories sorted by name.
+    For each directory, this generator yields (dirpath, entry) tuples:
+    first for every file, as it is found; then for every subdirectory, in
+    sorted order; and finally (dirpath, None) when the directory is done.
+    Entries are os.DirEntry objects, so that their cached stat results can be
+    reused.
+
+    Like os.walk, symbolic links to directories are reported as directories,
+    but not followed, and directories that can't be read are skipped.
+
+    With more than one thread, directories are read ahead of the walk by a
+    DirectoryScanner, and the files in a directory are only yielded once the
+    whole directory has been read. The order is the same.
+
+    :param top: directory to walk
+    :param descend: optional function that is called with the path of each
+                    subdirectory, and returns whether to walk it
+    :param threads: number of threads for reading directories"""
+
+    if threads > 1:
+        yield from _walk_vault_parallel(top, descend, threads)
+        return
+
+    stack = [top]
+
+    while stack:
+        dirpath = stack.pop()
+        subdirs = []
+
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        subdirs.append(entry)
+                    else:
+                        yield dirpath, entry
+        except OSError:
+            continue
+
+        subdirs.sort(key=lambda e: e.name)
+        for entry in subdirs:
+            yield dirpath, entry
+        yield dirpath, None
+
+        for entry in reversed(subdirs):
+            if entry.is_symlink():
+                continue
+            if descend is None or descend(entry.path):
+                stack.append(entry.path)
+
+
+def _walk_vault_parallel(top, descend, threads):
+    scanner = DirectoryScanner(threads, descend,
+                               priority=lambda path: path.split(os.sep))
+    try:
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            entries, walk_subdirs = scanner.read(dirpath)
+            if entries is None:
+                continue
+
+            subdirs = []
+            for entry, is_dir in entries:
+                if is_dir:
+                    subdirs.append(entry)
+                else:
+                    yield dirpath, entry
+
+            subdirs.sort(key=lambda e: e.name)
+            for entry in subdirs:
+                yield dirpath, entry
+            yield dirpath, None
+
+            for entry in reversed(subdirs):
+                if entry.path in walk_subdirs:
+                    stack.append(entry.path)
+    finally:
+        scanner.close()
+
+
+def walk_key(path, is_dir):
+    """Returns the key by which walk_vault_in_order orders paths. Directories
+    are ordered as if their path ended with a separator, so that the paths
+    of all files are visited in sorted order."""
+    return path + os.sep if is_dir else path
+
+
+def _sorted_entries(dirpath, scanner=None):
+    if scanner is not None:
+        entries, walk_subdirs = scanner.read(dirpath)
+        entries = sorted(((walk_key(entry.name, is_dir), is_dir, entry)
+                          for entry, is_dir in entries or []),
+                         key=lambda e: e[0])
+        return iter(entries), walk_subdirs
+
+    entries = []
+    try:
+        with os.scandir(dirpath) as scan:
+            for entry in scan:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((walk_key(entry.name, is_dir), is_dir, entry))
+    except OSError:
+        pass
+    entries.sort(key=lambda e: e[0])
+    return iter(entries), None
+
+
+def walk_vault_in_order(top, descend=None, threads=1):
+    """Walks a directory tree in sorted order of path, e.g. for merging it
+    with a sorted list of paths.
+
+    Yields (dirpath, entry, is_dir) tuples for all entries in the tree,
+    ordered by walk_key. A directory is yielded before its contents, and
+    (dirpath, None, True) is yielded when a directory is done. Only the
+    entries of the directories on the current path are held in memory.
+
+    Symbolic links to directories are reported as directories, but not
+    followed, and directories that can't be read are skipped.
+
+    With more than one thread, directories are read ahead of the walk by a
+    DirectoryScanner. The order is the same.
+
+    :param top: directory to walk
+    :param descend: optional function that is called with the path of each
+                    subdirectory, and returns whether to walk it
+    :param threads: number of threads for reading directories"""
+
+    scanner = None
+    if threads > 1:
+        scanner = DirectoryScanner(threads, descend,
+                                   priority=lambda path: walk_key(path, True))
+
+    try:
+        stack = [(top, *_sorted_entries(top, scanner))]
+
+        while stack:
+            dirpath, entries, walk_subdirs = stack[-1]
+            item = next(entries, None)
+            if item is None:
+                stack.pop()
+                yield dirpath, None, True
+                continue
+
+            key, is_dir, entry = item
+            yield dirpath, entry, is_dir
+            if walk_subdirs is not None:
+                walk = entry.path in walk_subdirs
+            else:
+                walk = (is_dir and not entry.is_symlink()
+                        and (descend is None or descend(entry.path)))
+            if walk:
+                stack.append((entry.path, *_sorted_entries(entry.path, scanner)))
+    finally:
+        if scanner is not None:
+            scanner.close()
@@ -0,0 +1,136 @@
+"""Run checks on a pool of worker threads, while keeping output in order"""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from ichk.locality import LOCATED, seek_distance
+
+
+class OrderedWorkerPool(object):
+    """Runs checks on a pool of worker threads and passes their results to a
+    consumer (typically a formatter) in the order in which they were submitted.
+
+    The number of pending results (submitted, but not yet consumed) is bounded,
+    so that memory usage does not grow with the size of the scan. With a single
+    worker, checks are run synchronously on the calling thread.
+
+    Checks can also be submitted with a location key (see submit_in_window and
+    locality.py). These are collected in a window of up to window checks,
+    which are run in order of their keys (in either direction), so that files
+    are read with fewer seeks."""
+
+    def __init__(self, consumer, workers=1, max_pending=None, window=0):
+        if workers < 1:
+            raise ValueError("Number of workers must be at least 1")
+        self.consumer = consumer
+        self.workers = workers
+        self.window = window
+        self.max_pending = (max_pending or 4 * workers) + window
+        self.pending = deque()
+        self.windowed = []
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.submitted_distance = 0
+        self.executed_distance = 0
+        self.last_submitted_key = None
+        self.last_executed_key = None
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs). Its return value is passed to the
+        consumer after the results of all previously submitted work."""
+        if self.executor is None:
+            self.put(fn(*args, **kwargs))
+        else:
+            self.pending.append(self.executor.submit(fn, *args, **kwargs))
+            self._drain(self.max_pending)
+
+    def submit_in_window(self, key, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) like submit, but run it together with
+        the other work in the window in order of key (e.g. the position of a
+        file on disk). Its return value is still passed to the consumer in
+        submission order. Work without a key is submitted normally."""
+        if not self.window or key is None:
+            self.submit(fn, *args, **kwargs)
+            return
+
+        future = Future()
+        self.pending.append(future)
+        self.windowed.append((key, future, fn, args, kwargs))
+        if len(self.windowed) >= self.window:
+            self._release_window()
+        self._drain(self.max_pending)
+
+    def _release_window(self):
+        """Run the work in the window in order of key, and keep track of the
+        seek distance in submission order and in the order that is run"""
+        windowed = self.windowed
+        self.windowed = []
+
+        distance, self.last_submitted_key = seek_distance(
+            (item[0] for item in windowed), self.last_submitted_key)
+        self.submitted_distance += distance
+        # Elevator order: sweep from the end of the window that is nearest
+        # to the last position, rather than jumping back to the start. Work
+        # of which the location is not known comes last.
+        windowed.sort(key=lambda item: item[0])
+        located = [item for item in windowed if item[0][0] == LOCATED]
+        last = self.last_executed_key
+        if (located and last is not None
+                and abs(located[-1][0][1] - last[1]) < abs(located[0][0][1] - last[1])):
+            located.reverse()
+            windowed[:len(located)] = located
+        distance, self.last_executed_key = seek_distance(
+            (item[0] for item in windowed), self.last_executed_key)
+        self.executed_distance += distance
+
+        for key, future, fn, args, kwargs in windowed:
+            if self.executor is None:
+                _run(future, fn, args, kwargs)
+            else:
+                self.executor.submit(fn, *args, **kwargs).add_done_callback(
+                    lambda done, future=future: _copy_result(done, future))
+
+    def put(self, result):
+        """Pass a result that is already available to the consumer, after the
+        results of all previously submitted work."""
+        if not self.pending:
+            self.consumer(result)
+        else:
+            future = Future()
+            future.set_result(result)
+            self.pending.append(future)
+            self._drain(self.max_pending)
+
+    def _drain(self, max_pending):
+        while self.pending and (len(self.pending) > max_pending
+                                or self.pending[0].done()):
+            if self.windowed and not self.pending[0].done():
+                # The oldest work may be waiting in the window
+                self._release_window()
+                continue
+            self.consumer(self.pending.popleft().result())
+
+    def flush(self):
+        """Wait for all pending work and pass its results to the consumer"""
+        if self.windowed:
+            self._release_window()
+        self._drain(0)
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def _run(future, fn, args, kwargs):
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+def _copy_result(done, future):
+    exception = done.exception()
+    if exception is None:
+        future.set_result(done.result())
+    else:
+        future.set_exception(exception)
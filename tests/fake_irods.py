@@ -0,0 +1,186 @@
+"""In-memory iRODS catalog for tests. Queries are python-irodsclient Query
+objects, so that they are built in the same way as with a real session;
+only their execution is replaced by a lookup in the catalog."""
+
+import operator
+import re
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from unittest import mock
+
+import irods.exception as iexc
+from irods.column import In, Like
+from irods.models import Collection, DataObject, Resource, Zone
+from irods.query import Query, query_number
+
+OPERATORS = {"=": operator.eq, "<>": operator.ne,
+             ">": operator.gt, ">=": operator.ge,
+             "<": operator.lt, "<=": operator.le}
+
+
+class FakeCatalog(object):
+    """Resources, collections and replicas of a zone. Results of queries are
+    returned in pages of page_size rows.
+
+    :param zone: name of the zone
+    :param page_size: number of rows in a page of query results"""
+
+    def __init__(self, zone="tempZone", page_size=2):
+        self.zone = zone
+        self.page_size = page_size
+        self.resources = []
+        self.collections = []
+        self.replicas = []
+
+    def add_resource(self, name, vault_path, location="localhost",
+                     resource_type="unixfilesystem", parent=None):
+        resource = {column: None for column in Resource._columns}
+        resource.update({Resource.id: 100 + len(self.resources),
+                         Resource.name: name,
+                         Resource.zone_name: self.zone,
+                         Resource.type: resource_type,
+                         Resource.location: location,
+                         Resource.vault_path: vault_path,
+                         Resource.parent: parent,
+                         Resource.children: ""})
+        self.resources.append(resource)
+        return resource
+
+    def add_collection(self, name):
+        for collection in self.collections:
+            if collection[Collection.name] == name:
+                return collection
+        collection = {column: None for column in Collection._columns}
+        collection.update({Collection.id: 10000 + len(self.collections),
+                           Collection.name: name})
+        self.collections.append(collection)
+        return collection
+
+    def add_replica(self, coll_name, name, resource_name, path, size, checksum,
+                    replica_number=0):
+        collection = self.add_collection(coll_name)
+        resource = next(resource for resource in self.resources
+                        if resource[Resource.name] == resource_name)
+        replica = {column: None for column in DataObject._columns}
+        replica.update(collection)
+        replica.update(resource)
+        replica.update({DataObject.id: 1 + len({row[DataObject.id] for row in self.replicas}),
+                        DataObject.collection_id: collection[Collection.id],
+                        DataObject.name: name,
+                        DataObject.replica_number: replica_number,
+                        DataObject.replica_status: "1",
+                        DataObject.resource_name: resource_name,
+                        DataObject.resc_hier: resource_name,
+                        DataObject.path: path,
+                        DataObject.size: size,
+                        DataObject.checksum: checksum,
+                        DataObject.modify_time: datetime.fromtimestamp(0, timezone.utc)})
+        for row in self.replicas:
+            if (row[Collection.name], row[DataObject.name]) == (coll_name, name):
+                replica[DataObject.id] = row[DataObject.id]
+        self.replicas.append(replica)
+        return replica
+
+    def rows(self, query):
+        """Returns the result rows of a query"""
+        models = {column.icat_id // 100 for column in query.columns}
+        models |= {criterion.query_key.icat_id // 100 for criterion in query.criteria}
+        if models == {Zone.id.icat_id // 100}:
+            table = [{Zone.id: 9000, Zone.name: self.zone}]
+        elif DataObject.id.icat_id // 100 in models or len(models) > 1:
+            table = self.replicas
+        elif Collection.id.icat_id // 100 in models:
+            table = self.collections
+        else:
+            table = self.resources
+
+        rows = []
+        seen = set()
+        for row in table:
+            if all(_matches(row, criterion) for criterion in query.criteria):
+                selected = {column: row[column] for column in query.columns}
+                key = tuple(str(value) for value in selected.values())
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(selected)
+
+        order = [column for column, value in query.columns.items()
+                 if value == query_number["ORDER_BY"]]
+        for column in reversed(order):
+            rows.sort(key=lambda row: row[column])
+
+        counted = [column for column, value in query.columns.items()
+                   if value == query_number["SELECT_COUNT"]]
+        if counted:
+            return [{column: len(rows) for column in counted}]
+        return rows
+
+    def get_batches(self, query):
+        rows = self.rows(query)
+        for start in range(0, max(len(rows), 1), self.page_size):
+            yield rows[start:start + self.page_size]
+
+
+def _matches(row, criterion):
+    value = row[criterion.query_key]
+    if isinstance(criterion, Like):
+        pattern = re.escape(criterion.value).replace("%", ".*").replace("_", ".")
+        return value is not None and re.fullmatch(pattern, str(value)) is not None
+    if isinstance(criterion, In):
+        return str(value) in [str(element) for element in criterion.value]
+    other = criterion.value
+    if isinstance(value, int):
+        other = int(other)
+    elif value is not None and not isinstance(value, datetime):
+        value, other = str(value), str(other)
+    return value is not None and OPERATORS[criterion.op](value, other)
+
+
+class FakeSession(object):
+    """Session whose queries are answered from a FakeCatalog, while
+    executing_queries is active"""
+
+    server_version = (4, 3, 2)
+    connection_timeout = 600
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.zone = catalog.zone
+
+    def query(self, *args, **kwargs):
+        return Query(self, *args, **kwargs)
+
+    def clone(self):
+        return FakeSession(self.catalog)
+
+    def cleanup(self):
+        pass
+
+
+def _first(query):
+    rows = query.sess.catalog.rows(query)
+    return rows[0] if rows else None
+
+
+def _one(query):
+    rows = query.sess.catalog.rows(query)
+    if not rows:
+        raise iexc.NoResultFound()
+    if len(rows) > 1:
+        raise iexc.MultipleResultsFound()
+    return rows[0]
+
+
+@contextmanager
+def executing_queries(get_batches=None):
+    """Context manager in which queries of FakeSessions are executed. The
+    pages of results can be produced by another function, e.g. to simulate
+    network errors."""
+    if get_batches is None:
+        def get_batches(query):
+            return query.sess.catalog.get_batches(query)
+
+    with mock.patch.object(Query, "get_batches", lambda query: get_batches(query)), \
+            mock.patch.object(Query, "first", _first), \
+            mock.patch.object(Query, "one", _one):
+        yield
@@ -0,0 +1,90 @@
+"""In-memory S3 bucket for tests, which answers the requests that
+S3ResourceInterface sends with a boto3 client."""
+
+import hashlib
+import io
+import os
+import tempfile
+from datetime import datetime, timezone
+
+import botocore.exceptions
+from irods.models import Resource
+
+from ichk.s3_resource_interface import S3ResourceInterface
+
+
+def client_error(code, operation):
+    return botocore.exceptions.ClientError({"Error": {"Code": code}}, operation)
+
+
+class StubS3Client(object):
+    """Objects of a single bucket, by key. Requests are recorded in
+    requests, as (operation, request) tuples.
+
+    :param page_size: number of objects in a page of a listing"""
+
+    def __init__(self, page_size=2):
+        self.page_size = page_size
+        self.objects = {}
+        self.requests = []
+
+    def put_object(self, key, data, etag=None, **metadata):
+        """Stores an object. The ETag is the MD5 checksum of the data,
+        unless another one (e.g. a multipart ETag) is given."""
+        if etag is None:
+            etag = hashlib.md5(data).hexdigest()
+        self.objects[key] = dict(metadata, Body=data, ETag='"{}"'.format(etag),
+                                 LastModified=datetime.now(timezone.utc))
+
+    def _get(self, operation, request):
+        self.requests.append((operation, request))
+        if request["Key"] not in self.objects:
+            raise client_error("404", operation)
+        return self.objects[request["Key"]]
+
+    def head_object(self, **request):
+        stored = self._get("HeadObject", request)
+        metadata = {name: value for name, value in stored.items() if name != "Body"}
+        metadata["ContentLength"] = len(stored["Body"])
+        return metadata
+
+    def get_object(self, **request):
+        stored = self._get("GetObject", request)
+        if "IfMatch" in request and request["IfMatch"] != stored["ETag"]:
+            raise client_error("PreconditionFailed", "GetObject")
+        data = stored["Body"]
+        if "Range" in request:
+            start, end = request["Range"][len("bytes="):].split("-")
+            data = data[int(start):int(end) + 1]
+        return {"Body": io.BytesIO(data), "ETag": stored["ETag"]}
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix, StartAfter=""):
+        self.requests.append(("ListObjectsV2", {"Prefix": Prefix, "StartAfter": StartAfter}))
+        keys = sorted(key for key in self.objects
+                      if key.startswith(Prefix) and key > StartAfter)
+        for start in range(0, len(keys), self.page_size):
+            yield {"Contents": [{"Key": key,
+                                 "Size": len(self.objects[key]["Body"]),
+                                 "ETag": self.objects[key]["ETag"],
+                                 "LastModified": self.objects[key]["LastModified"]}
+                                for key in keys[start:start + self.page_size]]}
+
+
+def s3_interface(resource, client, **options):
+    """Returns an S3ResourceInterface for a resource (a row of the catalog),
+    which sends its requests to client"""
+    with tempfile.NamedTemporaryFile("w", delete=False) as auth_file:
+        auth_file.write("access\nsecret\n")
+    try:
+        resource = dict(resource)
+        resource[Resource.context] = ("S3_DEFAULT_HOSTNAME=s3.example.org;S3_PROTO=HTTP;"
+                                      "S3_REGIONNAME=us-east-1;S3_AUTH_FILE=" + auth_file.name)
+        interface = S3ResourceInterface(resource, **options)
+    finally:
+        os.unlink(auth_file.name)
+    interface.boto3_client = client
+    return interface
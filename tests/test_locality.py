@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ichk import ufs_resource_interface
+from ichk.locality import LOCATED, seek_distance, UNLOCATED
+from ichk.ufs_resource_interface import UFSResourceInterface
+
+
+class LocalityKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.empty = os.path.join(directory, "empty")
+        self.full = os.path.join(directory, "full")
+        open(self.empty, "w").close()
+        with open(self.full, "w") as f:
+            f.write("data")
+        self.interface = UFSResourceInterface()
+
+    def test_inode(self):
+        key, metadata = self.interface.locality_key(self.full, method="inode")
+        self.assertEqual(key, (LOCATED, os.stat(self.full).st_ino))
+        self.assertEqual(metadata.st_size, 4)
+
+    def test_extent(self):
+        with mock.patch.object(ufs_resource_interface, "physical_offset", return_value=8192):
+            key, metadata = self.interface.locality_key(self.full, method="extent")
+        self.assertEqual(key, (LOCATED, 8192))
+
+    def test_no_extent(self):
+        with mock.patch.object(ufs_resource_interface, "physical_offset", return_value=None):
+            key, metadata = self.interface.locality_key(self.full, method="extent")
+        self.assertEqual(key, (UNLOCATED, os.stat(self.full).st_ino))
+
+        key, metadata = self.interface.locality_key(self.empty, method="extent")
+        self.assertEqual(key, (UNLOCATED, os.stat(self.empty).st_ino))
+
+    def test_missing_file(self):
+        self.assertEqual(self.interface.locality_key(self.full + ".missing", method="extent"),
+                         (None, None))
+
+    def test_seek_distance_of_located_files(self):
+        keys = [(LOCATED, 100), (UNLOCATED, 5), (LOCATED, 40), (UNLOCATED, 1000), (LOCATED, 70)]
+        self.assertEqual(seek_distance(keys), (60 + 30, (LOCATED, 70)))
+        self.assertEqual(seek_distance(keys, (LOCATED, 0)), (100 + 60 + 30, (LOCATED, 70)))
+        self.assertEqual(seek_distance([(UNLOCATED, 3)], (LOCATED, 10)), (0, (LOCATED, 10)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import io
+import unittest
+from unittest import mock
+
+import irods.exception as iexc
+from irods.models import Collection, DataObject
+
+from ichk.check import Check
+from tests.fake_irods import executing_queries, FakeCatalog, FakeSession
+
+
+class QueryResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = FakeCatalog(page_size=2)
+        self.catalog.add_resource("demoResc", "/vault")
+        self.catalog.add_resource("otherResc", "/other")
+        for coll_name in ("/tempZone/home/a", "/tempZone/home/b", "/tempZone/home/c"):
+            for name in ("x", "y", "z"):
+                for number, resource in enumerate(("demoResc", "otherResc")):
+                    self.catalog.add_replica(coll_name, name, resource,
+                                             "/vault" + coll_name + "/" + name, 1, "",
+                                             replica_number=number)
+        self.session = FakeSession(self.catalog)
+        self.failed = set()
+
+        for patcher in (mock.patch.object(Check, "RETRY_DELAY", 0),
+                        mock.patch("sys.stderr", io.StringIO())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def flaky_batches(self, query):
+        """Raises a network error after the first page of each query, once
+        per query"""
+        key = tuple((criterion.query_key.icat_key, criterion.op, str(criterion.value))
+                    for criterion in query.criteria)
+        for number, batch in enumerate(self.catalog.get_batches(query)):
+            if number == 1 and key not in self.failed:
+                self.failed.add(key)
+                raise iexc.NetworkException("Could not receive server response")
+            yield batch
+
+    def results(self, query, resume_key, get_batches=None, retries=5):
+        with executing_queries(get_batches):
+            check = Check(self.session, "localhost", None, query_retries=retries)
+            rows = [tuple(row[column] for column in resume_key or [DataObject.id])
+                    for row in check.query_results(query, resume_key)]
+        return rows, check.statistics.get("Catalog query retries")
+
+    def assert_resumed(self, query, resume_key):
+        expected, retries = self.results(query, resume_key)
+        self.assertEqual(retries, 0)
+        self.assertEqual(len(expected), len(set(expected)))
+
+        rows, retries = self.results(query, resume_key, self.flaky_batches)
+        self.assertEqual(rows, expected)
+        self.assertGreater(retries, 0)
+
+    def test_resume_by_id(self):
+        self.assert_resumed(
+            lambda: (self.session.query(DataObject, Collection.name)
+                     .filter(DataObject.resc_hier == "demoResc")
+                     .order_by(DataObject.id)),
+            [DataObject.id])
+
+    def test_resume_by_collection_and_name(self):
+        self.assert_resumed(
+            lambda: (self.session.query(DataObject, Collection.name)
+                     .filter(DataObject.resc_hier == "demoResc")
+                     .order_by(Collection.name)
+                     .order_by(DataObject.name)),
+            [Collection.name, DataObject.name])
+
+    def test_resume_by_path_and_id(self):
+        self.assert_resumed(
+            lambda: (self.session.query(DataObject, Collection.name)
+                     .filter(DataObject.resc_hier == "demoResc")
+                     .order_by(DataObject.path)
+                     .order_by(DataObject.id)),
+            [DataObject.path, DataObject.id])
+
+    def test_resume_by_id_and_replica_number(self):
+        self.assert_resumed(
+            lambda: (self.session.query(DataObject, Collection.name)
+                     .filter(Collection.name == "/tempZone/home/b")
+                     .order_by(DataObject.id)
+                     .order_by(DataObject.replica_number)),
+            [DataObject.id, DataObject.replica_number])
+
+    def test_no_retry_after_rows_without_resume_key(self):
+        def query():
+            return (self.session.query(DataObject.id)
+                    .filter(DataObject.resc_hier == "demoResc"))
+
+        with self.assertRaises(iexc.NetworkException):
+            self.results(query, None, self.flaky_batches)
+
+    def test_retries_exhausted(self):
+        def failing_batches(query):
+            raise iexc.NetworkException("Could not connect to specified host")
+            yield
+
+        def query():
+            return self.session.query(DataObject.id).order_by(DataObject.id)
+
+        with self.assertRaises(iexc.NetworkException):
+            self.results(query, [DataObject.id], failing_batches, retries=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
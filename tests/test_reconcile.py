@@ -0,0 +1,83 @@
+import csv
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ichk.check import ReconcileCheck
+from ichk.ufs_resource_interface import UFSResourceInterface
+from tests.fake_irods import executing_queries, FakeCatalog, FakeSession
+
+
+class ReconcileCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vault = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.vault)
+        self.catalog = FakeCatalog()
+        self.catalog.add_resource("demoResc", self.vault)
+
+        self.add_file("home/a/f1.txt", b"one", "/tempZone/home/a")
+        self.add_file("home/a/sub/f2.txt", b"two", "/tempZone/home/a/sub")
+        self.add_file("home/b/f3.txt", b"three", "/tempZone/home/b")
+        self.add_replica("home/a/missing.txt", b"gone", "/tempZone/home/a")
+        self.add_replica("home/a/gone/f4.txt", b"gone", "/tempZone/home/a/gone")
+        self.write_file("home/a/unregistered.txt", b"four")
+        os.makedirs(os.path.join(self.vault, "home/a/unregistered"))
+
+    def write_file(self, path, data):
+        path = os.path.join(self.vault, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def add_replica(self, path, data, coll_name):
+        self.catalog.add_replica(coll_name, os.path.basename(path), "demoResc",
+                                 os.path.join(self.vault, path), len(data),
+                                 hashlib.md5(data).hexdigest())
+
+    def add_file(self, path, data, coll_name):
+        self.write_file(path, data)
+        self.add_replica(path, data, coll_name)
+
+    def run_check(self, root_collection=None):
+        output = io.StringIO()
+        with executing_queries(), mock.patch("sys.stderr", io.StringIO()):
+            check = ReconcileCheck(FakeSession(self.catalog), "localhost",
+                                   self.vault, root_collection)
+            check.setformatter(output=output, fmt="csv")
+            check.run()
+            check.close()
+        return {(row["Physical Path"][len(self.vault):], row["Status"])
+                for row in csv.DictReader(io.StringIO(output.getvalue()))}
+
+    def test_root_collection(self):
+        self.assertEqual(self.run_check("/tempZone/home/a"), {
+            ("/home/a/f1.txt", "OK"),
+            ("/home/a/sub", "OK"),
+            ("/home/a/sub/f2.txt", "OK"),
+            ("/home/a/missing.txt", "NOT_EXISTING"),
+            ("/home/a/gone", "NOT_EXISTING"),
+            ("/home/a/gone/f4.txt", "NOT_EXISTING"),
+            ("/home/a/unregistered.txt", "NOT_REGISTERED"),
+            ("/home/a/unregistered", "NOT_REGISTERED")})
+
+    def test_no_second_pass_for_collections(self):
+        with mock.patch.object(UFSResourceInterface, "check_coll_exists") as check:
+            results = self.run_check()
+        check.assert_not_called()
+        self.assertIn(("/home/a/gone", "NOT_EXISTING"), results)
+        self.assertIn(("/home/a/sub", "OK"), results)
+
+    def test_whole_vault(self):
+        results = self.run_check()
+        self.assertIn(("/home/b/f3.txt", "OK"), results)
+        self.assertIn(("/home/a/missing.txt", "NOT_EXISTING"), results)
+        self.assertIn(("/home/a/unregistered", "NOT_REGISTERED"), results)
+
+
+if __name__ == "__main__":
+    unittest.main()
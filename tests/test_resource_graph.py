@@ -0,0 +1,25 @@
+import unittest
+
+from irods.models import Resource
+
+from ichk.resource_graph import ResourceGraph
+from tests.fake_irods import executing_queries, FakeCatalog, FakeSession
+
+
+class ResourceGraphTest(unittest.TestCase):
+
+    def test_children_sorted_by_name(self):
+        catalog = FakeCatalog()
+        root = catalog.add_resource("root", None, resource_type="passthru")
+        for name in ("c", "a", "b"):
+            catalog.add_resource(name, "/vault/" + name, parent=str(root[Resource.id]))
+
+        with executing_queries():
+            graph = ResourceGraph(FakeSession(catalog))
+
+        self.assertEqual([child[Resource.name] for child in graph.children(root)],
+                         ["a", "b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
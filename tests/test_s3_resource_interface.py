@@ -0,0 +1,78 @@
+import base64
+import hashlib
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+from ichk.s3_resource_interface import S3ResourceInterface
+from tests.fake_irods import FakeCatalog
+from tests.fake_s3 import s3_interface, StubS3Client
+
+PATH = "/bucket/demoVault/home/a/f1.txt"
+KEY = "Vault/home/a/f1.txt"
+DATA = bytes(range(256)) * 10
+
+
+class S3ResourceInterfaceTest(unittest.TestCase):
+
+    def setUp(self):
+        resource = FakeCatalog().add_resource("s3Resc", "/bucket/demoVault", resource_type="s3")
+        self.client = StubS3Client()
+        self.interface = s3_interface(resource, self.client, download_threads=3)
+        patcher = mock.patch.object(S3ResourceInterface, "RANGE_SIZE", 1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def listed(self):
+        return next(metadata for phy_path, metadata
+                    in self.interface.list_objects("/bucket/demoVault") if phy_path == PATH)
+
+    def operations(self):
+        return [operation for operation, request in self.client.requests
+                if operation != "ListObjectsV2"]
+
+    def test_single_part_etag(self):
+        self.client.put_object(KEY, DATA)
+        checksum = self.interface.get_checksum(PATH, "md5", self.listed())
+        self.assertEqual(checksum, hashlib.md5(DATA).hexdigest())
+        # The listing doesn't show the encryption of the object
+        self.assertEqual(self.operations(), ["HeadObject"])
+
+    def test_etag_of_encrypted_object(self):
+        self.client.put_object(KEY, DATA, ServerSideEncryption="aws:kms")
+        checksum = self.interface.get_checksum(PATH, "md5", self.listed())
+        self.assertEqual(checksum, hashlib.md5(DATA).hexdigest())
+        self.assertEqual(self.operations(), ["HeadObject"] + ["GetObject"] * 3)
+
+    def test_multipart_etag(self):
+        self.client.put_object(KEY, DATA, etag="0123456789abcdef0123456789abcdef-2")
+        checksum = self.interface.get_checksum(PATH, "md5", self.listed())
+        self.assertEqual(checksum, hashlib.md5(DATA).hexdigest())
+
+        ranges = [request for operation, request in self.client.requests
+                  if operation == "GetObject"]
+        self.assertEqual([request["Range"] for request in ranges],
+                         ["bytes=0-999", "bytes=1000-1999", "bytes=2000-2559"])
+        self.assertTrue(all(request["IfMatch"] == '"0123456789abcdef0123456789abcdef-2"'
+                            for request in ranges))
+        self.assertNotIn("HeadObject", self.operations())
+
+    def test_object_replaced_during_ranged_read(self):
+        self.client.put_object(KEY, DATA, etag="0123456789abcdef0123456789abcdef-2")
+        metadata = self.listed()
+        self.client.put_object(KEY, DATA[::-1], etag="fedcba9876543210fedcba9876543210-2")
+
+        with self.assertRaises(botocore.exceptions.ClientError) as raised:
+            self.interface.get_checksum(PATH, "md5", metadata)
+        self.assertEqual(raised.exception.response["Error"]["Code"], "PreconditionFailed")
+
+    def test_sha256_of_small_object(self):
+        self.client.put_object(KEY, DATA[:100])
+        checksum = self.interface.get_checksum(PATH, "sha2", self.listed())
+        self.assertEqual(checksum, base64.b64encode(hashlib.sha256(DATA[:100]).digest()).decode())
+        self.assertEqual(self.operations(), ["GetObject"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import csv
+import hashlib
+import io
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from irods.models import DataObject
+
+from ichk.check import VaultCheck
+from tests.fake_irods import executing_queries, FakeCatalog, FakeSession
+from tests.fake_s3 import s3_interface, StubS3Client
+
+VAULT = "/bucket/demoVault"
+
+
+class S3VaultCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = FakeCatalog()
+        self.resource = self.catalog.add_resource("s3Resc", VAULT, resource_type="s3")
+        self.client = StubS3Client()
+
+        self.add_object("home/a/f1.txt", b"one", "/tempZone/home/a")
+        self.add_object("home/a/f2.txt", b"two", "/tempZone/home/a")
+        self.add_object("home/b/f3.txt", b"three", "/tempZone/home/b")
+        self.client.put_object("Vault/home/a/orphan.txt", b"four")
+        self.client.put_object("Vault/home/b/orphan.txt", b"five")
+
+    def add_object(self, path, data, coll_name, modify_time=None):
+        self.client.put_object("Vault/" + path, data)
+        replica = self.catalog.add_replica(coll_name, path.rsplit("/", 1)[1], "s3Resc",
+                                           VAULT + "/" + path, len(data),
+                                           hashlib.md5(data).hexdigest())
+        replica[DataObject.modify_time] = modify_time or datetime.now(timezone.utc)
+
+    def run_check(self, **options):
+        output = io.StringIO()
+        with executing_queries(), mock.patch("sys.stderr", io.StringIO()):
+            check = VaultCheck(FakeSession(self.catalog), "localhost", VAULT, None,
+                               **options)
+            check.interface_factory.resource_interface_cache["s3Resc"] = s3_interface(
+                self.resource, self.client)
+            check.setformatter(output=output, fmt="csv")
+            with mock.patch.object(check, "get_data_object",
+                                   wraps=check.get_data_object) as get_data_object:
+                check.run()
+                check.close()
+        results = {(row["Physical Path"][len(VAULT):], row["Status"])
+                   for row in csv.DictReader(io.StringIO(output.getvalue()))}
+        return results, get_data_object.call_count
+
+    def test_no_lookups_of_unregistered_objects(self):
+        results, lookups = self.run_check()
+        self.assertEqual(results, {("/home/a/f1.txt", "OK"),
+                                   ("/home/a/f2.txt", "OK"),
+                                   ("/home/b/f3.txt", "OK"),
+                                   ("/home/a/orphan.txt", "NOT_REGISTERED"),
+                                   ("/home/b/orphan.txt", "NOT_REGISTERED")})
+        self.assertEqual(lookups, 0)
+
+    def test_lookups_in_incremental_check(self):
+        self.add_object("home/b/old.txt", b"six", "/tempZone/home/b",
+                        modify_time=datetime(2000, 1, 1, tzinfo=timezone.utc))
+        results, lookups = self.run_check(
+            modified_since=datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp())
+        self.assertIn(("/home/b/old.txt", "OK"), results)
+        self.assertIn(("/home/b/orphan.txt", "NOT_REGISTERED"), results)
+        self.assertEqual(lookups, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
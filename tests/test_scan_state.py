@@ -0,0 +1,56 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ichk.command import get_args, get_modified_since, get_scan_state
+
+
+class ScanStateTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state_file = os.path.join(directory, "state.json")
+        patcher = mock.patch("sys.stderr", io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scan_state(self, *options):
+        argv = ["ichk", "-r", "demoResc", "--state-file", self.state_file] + list(options)
+        with mock.patch("sys.argv", argv):
+            args = get_args()
+        state, resume_data = get_scan_state(args)
+        return args, state, resume_data
+
+    def run_scan(self, started, completed, *options):
+        args, state, resume_data = self.scan_state(*options)
+        state.save({"started": started, "completed": completed, "progress": {}})
+        return get_modified_since(args, state, resume_data)
+
+    def test_interrupted_full_scan_keeps_last_completed_start(self):
+        self.assertIsNone(self.run_scan(1000, True))
+        self.assertIsNone(self.run_scan(2000, False))
+
+        args, state, resume_data = self.scan_state("--since-last-run")
+        self.assertEqual(get_modified_since(args, state, resume_data), 1000)
+
+    def test_completed_scan_replaces_last_completed_start(self):
+        self.run_scan(1000, True)
+        self.assertEqual(self.run_scan(2000, True, "--since-last-run"), 1000)
+
+        args, state, resume_data = self.scan_state("--since-last-run")
+        self.assertEqual(get_modified_since(args, state, resume_data), 2000)
+
+    def test_full_scan_replaces_state_of_other_objects(self):
+        self.run_scan(1000, True, "-s", "/tempZone/home")
+        self.assertIsNone(self.run_scan(2000, False))
+
+        args, state, resume_data = self.scan_state("--since-last-run")
+        self.assertIsNone(get_modified_since(args, state, resume_data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+import irods.exception as iexc
+
+from ichk.session_pool import SessionPool
+from tests.fake_irods import executing_queries, FakeCatalog, FakeSession
+
+
+class StubSession(object):
+    """Session whose queries fail while the server has dropped its
+    connections, until it reconnects"""
+
+    def __init__(self):
+        self.connection_timeout = 120
+        self.dropped = False
+        self.queries = []
+        self.cleanups = 0
+
+    def clone(self):
+        return StubSession()
+
+    def cleanup(self):
+        self.cleanups += 1
+        self.dropped = False
+
+    def query(self, *columns):
+        return self
+
+    def first(self):
+        self.queries.append(self.connection_timeout)
+        if self.dropped:
+            raise iexc.NetworkException("Could not receive server response")
+        return {}
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool(StubSession(), size=1)
+        self.session = self.pool.acquire()
+        self.pool.release(self.session)
+
+    def test_new_session_is_not_checked(self):
+        self.assertEqual(self.session.queries, [])
+
+    def test_healthy_session_is_reused(self):
+        self.assertIs(self.pool.acquire(), self.session)
+        self.assertEqual(self.session.queries, [SessionPool.HEALTH_CHECK_TIMEOUT])
+        self.assertEqual(self.session.connection_timeout, 120)
+        self.assertEqual(self.session.cleanups, 0)
+        self.assertEqual(self.pool.reconnects, 0)
+
+    def test_dropped_session_reconnects(self):
+        self.session.dropped = True
+        self.assertIs(self.pool.acquire(), self.session)
+        self.assertEqual(self.session.connection_timeout, 120)
+        self.assertEqual(self.session.cleanups, 1)
+        self.assertEqual(self.pool.reconnects, 1)
+
+    def test_health_check_query(self):
+        pool = SessionPool(FakeSession(FakeCatalog()))
+        session = pool.acquire()
+        pool.release(session)
+        with executing_queries():
+            self.assertIs(pool.acquire(), session)
+        self.assertEqual(pool.reconnects, 0)
+
+    def test_idle_session_reconnects(self):
+        self.pool.max_idle_time = -1
+        self.pool.acquire()
+        self.assertEqual(self.session.queries, [])
+        self.assertEqual(self.session.cleanups, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import argparse
+import csv
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ichk import merge
+from ichk.check import ObjectListCheck, ReconcileCheck, ResourceCheck, VaultCheck
+from ichk.shard import Shard
+from tests.fake_irods import executing_queries, FakeCatalog, FakeSession
+
+SHARDS = 3
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.vault = os.path.join(self.directory, "vault")
+        self.catalog = FakeCatalog()
+        self.catalog.add_resource("demoResc", self.vault)
+
+        self.object_names = []
+        for top in ("a", "b", "c", "g", "h", "z"):
+            for sub in ("", "/sub"):
+                coll_name = "/tempZone/" + top + sub
+                for name in ("f1.txt", "f2.txt"):
+                    self.add_file(coll_name, name, (coll_name + name).encode())
+                self.add_file(coll_name, "missing.txt", None)
+                self.write_file(coll_name, "unregistered.txt", b"unregistered")
+        self.write_file("/tempZone", "top.txt", b"top")
+
+        patcher = mock.patch("sys.stderr", io.StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_file(self, coll_name, name, data):
+        path = os.path.join(self.vault + coll_name[len("/tempZone"):], name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def add_file(self, coll_name, name, data):
+        if data is None:
+            path = os.path.join(self.vault + coll_name[len("/tempZone"):], name)
+            data = b""
+        else:
+            path = self.write_file(coll_name, name, data)
+        self.catalog.add_replica(coll_name, name, "demoResc", path, len(data),
+                                 hashlib.md5(data).hexdigest())
+        self.object_names.append(coll_name + "/" + name)
+
+    def run_check(self, make_check, shard):
+        name = "unsharded" if shard is None else "shard-{}".format(shard.index)
+        output_path = os.path.join(self.directory, name + ".csv")
+        with executing_queries(), open(output_path, "w", newline="") as output:
+            check = make_check(FakeSession(self.catalog), shard)
+            check.setformatter(output=output, fmt="csv")
+            check.run()
+            check.close()
+        return output_path
+
+    def read_rows(self, path):
+        with open(path, newline="") as f:
+            return list(csv.reader(f))
+
+    def assert_merged_equal(self, make_check):
+        """Checks that the merged output of all shards of a check, created by
+        make_check(session, shard), has the same rows as an unsharded run"""
+        unsharded = self.read_rows(self.run_check(make_check, None))
+        inputs = [self.run_check(make_check, Shard(index, SHARDS))
+                  for index in range(1, SHARDS + 1)]
+        shard_rows = [len(self.read_rows(path)) - 1 for path in inputs]
+        # Each shard has part of the work
+        self.assertTrue(all(0 < rows < len(unsharded) - 1 for rows in shard_rows), shard_rows)
+
+        merged_path = os.path.join(self.directory, "merged.csv")
+        merge.main(argparse.Namespace(inputs=inputs, output=merged_path))
+        merged = self.read_rows(merged_path)
+        self.assertEqual(merged[0], unsharded[0])
+        self.assertEqual(sorted(merged[1:]), sorted(unsharded[1:]))
+
+    def test_resource_mode(self):
+        self.assert_merged_equal(lambda session, shard: ResourceCheck(
+            session, "localhost", "demoResc", None, shard=shard))
+
+    def test_resource_mode_streamed(self):
+        self.assert_merged_equal(lambda session, shard: ResourceCheck(
+            session, "localhost", "demoResc", None, stream_catalog=True, shard=shard))
+
+    def test_vault_mode(self):
+        self.assert_merged_equal(lambda session, shard: VaultCheck(
+            session, "localhost", self.vault, None, shard=shard))
+
+    def test_reconcile(self):
+        self.assert_merged_equal(lambda session, shard: ReconcileCheck(
+            session, "localhost", self.vault, None, shard=shard))
+
+    def test_object_list(self):
+        list_path = os.path.join(self.directory, "objects.txt")
+        with open(list_path, "w") as f:
+            f.write("\n".join(self.object_names + ["/tempZone/a/unknown.txt"]) + "\n")
+
+        def make_check(session, shard):
+            object_list = open(list_path)
+            self.addCleanup(object_list.close)
+            return ObjectListCheck(session, "localhost", object_list, shard=shard)
+
+        self.assert_merged_equal(make_check)
+
+
+if __name__ == "__main__":
+    unittest.main()
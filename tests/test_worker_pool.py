@@ -0,0 +1,169 @@
+import threading
+import time
+import unittest
+
+from ichk.locality import LOCATED, UNLOCATED
+from ichk.worker_pool import OrderedWorkerPool
+
+
+class OrderedWorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.results = []
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def check(self, number, delay):
+        time.sleep(delay)
+        with self.lock:
+            self.finished.append(number)
+        return number
+
+    def run_pool(self, delays, **options):
+        pool = OrderedWorkerPool(self.results.append, **options)
+        for number, delay in enumerate(delays):
+            pool.submit(self.check, number, delay)
+        pool.close()
+
+    def test_output_in_submission_order(self):
+        # Later checks finish first
+        delays = [0.01 * (20 - number) for number in range(20)]
+        self.run_pool(delays, workers=4)
+        self.assertNotEqual(self.finished, sorted(self.finished))
+        self.assertEqual(self.results, list(range(20)))
+
+    def test_same_output_as_single_thread(self):
+        delays = [0.001 * (number * 7 % 5) for number in range(50)]
+        self.run_pool(delays, workers=1)
+        single_threaded = self.results
+        self.results = []
+        self.run_pool(delays, workers=8)
+        self.assertEqual(self.results, single_threaded)
+
+    def test_results_that_are_already_available(self):
+        pool = OrderedWorkerPool(self.results.append, workers=4)
+        pool.submit(self.check, 0, 0.05)
+        pool.put("available")
+        pool.submit(self.check, 1, 0)
+        pool.close()
+        self.assertEqual(self.results, [0, "available", 1])
+
+    def test_pending_results_are_bounded(self):
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def blocked(number):
+            started.release()
+            release.wait()
+            return number
+
+        pool = OrderedWorkerPool(self.results.append, workers=2, max_pending=3)
+        thread = threading.Thread(target=lambda: [pool.submit(blocked, number)
+                                                  for number in range(10)])
+        thread.start()
+        try:
+            started.acquire()
+            started.acquire()
+            time.sleep(0.05)
+            # The submitting thread waits for the first result
+            self.assertEqual(len(pool.pending), 3)
+            self.assertEqual(self.results, [])
+        finally:
+            release.set()
+            thread.join()
+        pool.close()
+        self.assertEqual(self.results, list(range(10)))
+
+    def test_exception_is_raised_in_order(self):
+        def failing():
+            raise ValueError("check failed")
+
+        pool = OrderedWorkerPool(self.results.append, workers=4)
+        pool.submit(self.check, 0, 0.05)
+        pool.submit(failing)
+        with self.assertRaises(ValueError):
+            pool.close()
+        self.assertEqual(self.results, [0])
+
+
+class LocalityWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.results = []
+        self.executed = []
+        self.lock = threading.Lock()
+
+    def check(self, key, delay=0):
+        time.sleep(delay)
+        with self.lock:
+            self.executed.append(key)
+        return key
+
+    def run_pool(self, keys, delays=None, **options):
+        """Submits checks of files at positions (or location keys), which
+        return their position"""
+        pool = OrderedWorkerPool(self.results.append, **options)
+        for number, key in enumerate(keys):
+            if not isinstance(key, tuple):
+                key = (LOCATED, key)
+            pool.submit_in_window(key, self.check, key[1], delays[number] if delays else 0)
+        pool.close()
+        return pool
+
+    def test_run_in_order_of_key(self):
+        keys = [40, 10, 30, 20, 80, 50, 70, 60]
+        pool = self.run_pool(keys, window=4)
+        self.assertEqual(self.executed, sorted(keys))
+        self.assertEqual(self.results, keys)
+        self.assertEqual(pool.submitted_distance, 30 + 20 + 10 + 60 + 30 + 20 + 10)
+        self.assertEqual(pool.executed_distance, 70)
+
+    def test_sweep_back_from_last_position(self):
+        keys = [40, 10, 30, 20, 0, 5, 1, 3]
+        self.run_pool(keys, window=4)
+        self.assertEqual(self.executed, [10, 20, 30, 40, 5, 3, 1, 0])
+        self.assertEqual(self.results, keys)
+
+    def test_partial_window_is_run_on_close(self):
+        keys = [3, 1, 2]
+        self.run_pool(keys, window=4)
+        self.assertEqual(self.executed, [1, 2, 3])
+        self.assertEqual(self.results, keys)
+
+    def test_work_without_key(self):
+        pool = OrderedWorkerPool(self.results.append, window=4)
+        pool.submit_in_window((LOCATED, 30), self.check, 30)
+        pool.submit(self.check, "submitted")
+        pool.submit_in_window(None, self.check, "no key")
+        pool.submit_in_window((LOCATED, 10), self.check, 10)
+        pool.close()
+        # Only the work in the window waits
+        self.assertEqual(self.executed, ["submitted", "no key", 10, 30])
+        self.assertEqual(self.results, [30, "submitted", "no key", 10])
+
+    def test_unlocated_keys(self):
+        keys = [(LOCATED, 400), (UNLOCATED, 2), (LOCATED, 100), (UNLOCATED, 1),
+                (LOCATED, 50), (LOCATED, 300), (UNLOCATED, 3), (LOCATED, 0)]
+        pool = self.run_pool(keys, window=4)
+        # Files without a location come after the others, in order of inode
+        self.assertEqual(self.executed, [100, 400, 1, 2, 300, 50, 0, 3])
+        self.assertEqual(self.results, [key[1] for key in keys])
+        # Only the distances between located files count
+        self.assertEqual(pool.submitted_distance, 300 + 50 + 250 + 300)
+        self.assertEqual(pool.executed_distance, 300 + 100 + 250 + 50)
+
+    def test_same_output_as_single_thread(self):
+        keys = [number * 37 % 101 for number in range(60)]
+        delays = [0.001 * (number * 7 % 5) for number in range(60)]
+        self.run_pool(keys, delays, workers=1)
+        single_threaded = self.results
+
+        self.results = []
+        self.executed = []
+        self.run_pool(keys, delays, workers=4, window=8)
+        self.assertNotEqual(self.executed, keys)
+        self.assertEqual(self.results, single_threaded)
+
+
+if __name__ == "__main__":
+    unittest.main()